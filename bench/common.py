@@ -0,0 +1,92 @@
+""" helpers shared by the benchmarks """
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# highest resolution clock available (python 2 lacks perf_counter)
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def setup_module_utils():
+    """ makes module_utils of this repository importable as
+    ansible.module_utils. requires ansible to be installed. """
+    import ansible.module_utils
+    path = os.path.join(ROOT, 'module_utils')
+    if path not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(path)
+
+
+def load_library(name):
+    """ loads module library/<name>.py without running it """
+    setup_module_utils()
+    path = os.path.join(ROOT, 'library', name + '.py')
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:  # python 2
+        import imp
+        module = imp.load_source(name, path)
+    return module
+
+
+def measure(fn, setup=None, repeat=5, number=1):
+    """ returns list of seconds per call of fn() for each repetition.
+    setup() is called before each repetition outside of the measurement
+    and its result is passed to fn. """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = clock()
+        for _ in range(number):
+            fn(arg)
+        times.append((clock() - start) / number)
+    return times
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def metadata():
+    """ describes environment and commit the results belong to """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(commit=commit, python=platform.python_version(),
+                machine=platform.machine(), time=int(time.time()),
+                argv=sys.argv[1:])
+
+
+def write_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(dict(meta=metadata(), results=results), f, indent=2,
+                  sort_keys=True)
+
+
+def compare_results(base_path, results, tolerance):
+    """ prints results slower than the ones at base_path by more than factor
+    tolerance. The fastest repetition is compared since it is least
+    affected by noise. returns False if there are any. """
+    with open(base_path) as f:
+        base = dict((r['name'], r) for r in json.load(f)['results'])
+    ok = True
+    for r in results:
+        if r['name'] not in base or not base[r['name']]['min']:
+            continue
+        ratio = r['min'] / base[r['name']]['min']
+        if ratio > tolerance:
+            ok = False
+            print("REGRESSION %-40s %6.2fx" % (r['name'], ratio))
+    return ok
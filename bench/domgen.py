@@ -0,0 +1,92 @@
+""" generates synthetic libvirt domain definitions.
+
+desired_xml() resembles a template like templates/dom.xml.j2, current_xml()
+what libvirt returns for it using XMLDesc: devices get addresses, aliases
+and MAC addresses, controllers and defaults are added and memory is given in
+KiB. Disks may have a chain of backing stores to produce deep trees.
+"""
+
+
+def _disk(i, current, depth):
+    xml = "<disk type='file' device='disk'>" \
+        "<driver name='qemu' type='qcow2'%s/>" \
+        "<source file='/var/lib/libvirt/images/disk%d.qcow2'/>" % (
+            " cache='none'" if current else "", i)
+    if current:
+        xml += "<backingStore type='file'><format type='qcow2'/>" * depth
+        xml += "<source file='/base.qcow2'/>" if depth else ""
+        xml += "</backingStore>" * depth
+    xml += "<target dev='vd%s' bus='virtio'/>" % _devname(i)
+    if current:
+        xml += "<alias name='virtio-disk%d'/>" \
+            "<address type='pci' domain='0x0000' bus='0x%02x' " \
+            "slot='0x00' function='0x0'/>" % (i, i % 256)
+    return xml + "</disk>"
+
+
+def _interface(i, current):
+    xml = "<interface type='network'>"
+    if current:
+        xml += "<mac address='52:54:00:%02x:%02x:%02x'/>" % (
+            (i >> 16) & 255, (i >> 8) & 255, i & 255)
+    xml += "<source network='net%d'/>" % (i % 4)
+    if current:
+        xml += "<target dev='vnet%d'/>" % i
+    xml += "<model type='virtio'/>"
+    if current:
+        xml += "<alias name='net%d'/>" \
+            "<address type='pci' domain='0x0000' bus='0x%02x' " \
+            "slot='0x01' function='0x0'/>" % (i, i % 256)
+    return xml + "</interface>"
+
+
+def _devname(i):
+    name = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        name = chr(ord('a') + r) + name
+    return name
+
+
+def domain_xml(disks, nics, current=False, depth=0):
+    """ returns domain definition with given number of disks and network
+    interfaces. current adds what libvirt adds, depth is the length of the
+    backing store chain of each disk in the current definition. """
+    xml = "<domain type='kvm'%s><name>bench</name>" % (
+        " id='1'" if current else "")
+    if current:
+        xml += "<uuid>5b8d3a2c-1c2d-4f1e-9a6b-0c7d2e3f4a5b</uuid>" \
+            "<memory unit='KiB'>1048576</memory>" \
+            "<currentMemory unit='KiB'>1048576</currentMemory>"
+    else:
+        xml += "<memory unit='M'>1024</memory>"
+    xml += "<vcpu placement='static'>2</vcpu>" \
+        "<os><type arch='x86_64' machine='pc-i440fx-2.1'>hvm</type>" \
+        "<boot dev='hd'/></os><features><acpi/><apic/></features>" \
+        "<devices><emulator>/usr/bin/kvm</emulator>"
+    xml += "".join(_disk(i, current, depth) for i in range(disks))
+    if current:
+        xml += "<controller type='usb' index='0' model='piix3-uhci'>" \
+            "<alias name='usb'/></controller>" \
+            "<controller type='pci' index='0' model='pci-root'>" \
+            "<alias name='pci.0'/></controller>"
+        xml += "".join(
+            "<controller type='pci' index='%d' model='pci-bridge'>"
+            "<model name='pci-bridge'/><target chassisNr='%d'/>"
+            "<alias name='pci.%d'/></controller>" % (i, i, i)
+            for i in range(1, 1 + (disks + nics) // 31))
+    xml += "".join(_interface(i, current) for i in range(nics))
+    xml += "<serial type='pty'><target port='0'/></serial>" \
+        "<memballoon model='virtio'/>"
+    if current:
+        xml += "<input type='mouse' bus='ps2'><alias name='input0'/></input>"
+    return xml + "</devices></domain>"
+
+
+def desired_xml(devices, depth=0):
+    return domain_xml(devices, devices)
+
+
+def current_xml(devices, depth=0):
+    return domain_xml(devices, devices, current=True, depth=depth)
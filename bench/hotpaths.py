@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+""" benchmarks the XML comparison and state planning hot paths.
+
+Synthetic domain definitions with an increasing number of disks and network
+interfaces (see domgen.py) are compared against what libvirt would return.
+State planning is measured for every pair of states.
+
+    python bench/hotpaths.py [--sizes 1,10,100] [--depth N] [--repeat N]
+                             [--json PATH] [--compare BASE.json]
+
+Results are written as JSON including the commit, so runs of different
+commits can be compared using --compare, which fails if a benchmark got
+slower than the base by more than --tolerance.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import xml.etree.ElementTree as ET
+
+import common
+import domgen
+
+
+def bench_xml(results, sizes, depth, repeat):
+    from ansible.module_utils.virt_common import xmlutil
+    for n in sizes:
+        desired = domgen.desired_xml(n)
+        current = domgen.current_xml(n, depth)
+
+        def trees():
+            return ET.fromstring(desired), ET.fromstring(current)
+
+        cases = [
+            ('parse', lambda t: trees(), None),
+            ('xml_diff', lambda t: xmlutil.xml_diff(t[0], t[1]), trees),
+            ('xml_cmp', lambda t: xmlutil.xml_cmp(t[0], t[1], True), trees),
+            ('xml_by_tag_and_text',
+             lambda d: xmlutil.xml_by_tag_and_text(d),
+             lambda: ET.fromstring(current).find('devices')),
+            ('xml_text', lambda t: [xmlutil.xml_text(e) for e in t.iter()],
+             lambda: ET.fromstring(current)),
+        ]
+        for name, fn, setup in cases:
+            times = common.measure(fn, setup, repeat)
+            results.append(dict(name="%s/devices=%d/depth=%d" % (
+                name, 2 * n, depth), median=common.median(times),
+                min=min(times), repeat=repeat))
+
+
+def bench_states(results, repeat):
+    virt_domain = common.load_library('virt_domain')
+    states = virt_domain.all_states_pos_real + ['undefined']
+
+    def build(_):
+        virt_domain.state_plans.clear()
+        virt_domain.state_plans_for(False, True)
+    times = common.measure(build, None, repeat)
+    results.append(dict(name="state_plans_for/cold",
+                        median=common.median(times), min=min(times),
+                        repeat=repeat))
+
+    for transient in (False, True):
+        for graceful in (True, False):
+            for src in states:
+                for dst in states:
+                    if src == dst:
+                        continue
+
+                    def plan(_):
+                        virt_domain.state_transition(src, dst, transient,
+                                                     graceful)
+                    times = common.measure(plan, None, repeat, number=100)
+                    results.append(dict(
+                        name="state_transition/%s-%s/transient=%s/"
+                        "graceful=%s" % (src, dst, transient, graceful),
+                        median=common.median(times), min=min(times),
+                        repeat=repeat))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='1,10,50,100,200,500',
+                        help="comma separated numbers of disks and NICs")
+    parser.add_argument('--depth', type=int, default=2,
+                        help="length of backing store chains")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help="write results to file")
+    parser.add_argument('--compare', help="results of a previous run")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="allowed slowdown factor for --compare")
+    args = parser.parse_args(argv)
+
+    common.setup_module_utils()
+    results = []
+    bench_xml(results, [int(s) for s in args.sizes.split(',')], args.depth,
+              args.repeat)
+    bench_states(results, args.repeat)
+
+    for r in results:
+        print("%-60s %12.6f s" % (r['name'], r['median']))
+    if args.json:
+        common.write_results(args.json, results)
+    if args.compare and \
+            not common.compare_results(args.compare, results, args.tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
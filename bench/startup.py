@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+""" measures cold start time of the modules.
+
+Each module is loaded (without running main) in a fresh interpreter several
+times. The median time is compared to a baseline interpreter importing
+ansible.module_utils.basic only. The script fails if the overhead of a module
+exceeds the budget or if a module imports a heavy dependency eagerly.
+
+    python bench/startup.py [--runs N] [--budget MS] [--json PATH]
+
+The modules are loaded from library/ using module_utils/ of this repository,
+so ansible has to be installed in the interpreter running the benchmark.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['virt_domain', 'virt_domain_stats', 'virt_domain_wait',
+           'virt_facts', 'virt_net', 'virt_vol']
+
+# dependencies which should only be imported by paths using them
+HEAVY = ['libvirt', 'xml.etree.ElementTree']
+
+CHILD = '''
+import json, sys, time
+start = time.time()
+import ansible.module_utils
+ansible.module_utils.__path__.append(%(utils)r)
+import ansible.module_utils.basic
+path = %(path)r
+if path:
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('bench_module', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:  # python 2
+        import imp
+        imp.load_source('bench_module', path)
+print(json.dumps(dict(seconds=time.time() - start,
+                      modules=[m for m in %(heavy)r if m in sys.modules])))
+'''
+
+
+def run_child(path):
+    """ loads module at path (None for baseline) in a fresh interpreter.
+    returns tuple of wall time in seconds including interpreter startup and
+    heavy modules imported. """
+    code = CHILD % dict(utils=os.path.join(ROOT, 'module_utils'),
+                        path=path, heavy=HEAVY)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    res = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    return res['seconds'], res['modules']
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=9)
+    parser.add_argument('--budget', type=float, default=50,
+                        help="allowed overhead per module in milliseconds")
+    parser.add_argument('--json', help="write results to file")
+    args = parser.parse_args(argv)
+
+    baseline_runs = [run_child(None) for _ in range(args.runs)]
+    baseline = median([t for t, _ in baseline_runs])
+    baseline_heavy = set(baseline_runs[0][1])
+
+    results = dict(python=sys.version.split()[0], runs=args.runs,
+                   budget_ms=args.budget, baseline_ms=baseline * 1000,
+                   modules={})
+    ok = True
+    for name in MODULES:
+        path = os.path.join(ROOT, 'library', name + '.py')
+        runs = [run_child(path) for _ in range(args.runs)]
+        overhead = (median([t for t, _ in runs]) - baseline) * 1000
+        eager = sorted(set(runs[0][1]) - baseline_heavy)
+        results['modules'][name] = dict(overhead_ms=overhead,
+                                        eager_imports=eager)
+        passed = overhead <= args.budget and not eager
+        ok = ok and passed
+        print("%-18s %8.1f ms %s%s" % (
+            name, overhead, "ok" if passed else "FAIL",
+            (" (eager: %s)" % ", ".join(eager)) if eager else ""))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
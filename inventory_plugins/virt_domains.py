@@ -0,0 +1,115 @@
+""" inventory of the domains of libvirt hypervisors
+
+Uses the helpers of module_utils/virt_common, which are made importable as
+ansible.module_utils.virt_common from the directory next to this one.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: virt_domains
+    plugin_type: inventory
+    short_description: domains of libvirt hypervisors
+    description:
+        - Fetches all domains and their statistics using one call per
+          hypervisor and caches them on disk (see module virt_facts).
+        - Domains are grouped by state (e.g. virt_running) and hypervisor.
+        - Configuration files have to end with virt_domains.yml or
+          virt_domains.yaml.
+    options:
+        plugin:
+            description: token ensuring this is a source file for the plugin
+            required: True
+            choices: ['virt_domains']
+        hypervisors:
+            description:
+                - list of libvirt URIs or dicts of C(uri) and C(group), the
+                  name of the group of its domains
+            type: list
+            required: True
+        broker:
+            description: connect through the connection broker if running
+            type: bool
+            default: True
+        xml:
+            description: summarize domain definitions
+            type: bool
+            default: True
+        cache_dir:
+            description: directory of the facts cache
+            default: ~/.cache/virt_facts
+        cache_ttl:
+            description: seconds cached facts are used, 0 disables the cache
+            type: int
+            default: 300
+'''
+
+EXAMPLES = '''
+# virt_domains.yml
+plugin: virt_domains
+hypervisors:
+  - qemu:///system
+  - uri: qemu+ssh://hv1/system
+    group: hv1
+'''
+
+import os
+
+import ansible.module_utils
+from ansible.errors import AnsibleParserError
+from ansible.plugins.inventory import BaseInventoryPlugin
+
+MODULE_UTILS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'module_utils')
+if MODULE_UTILS not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.append(MODULE_UTILS)
+
+from ansible.module_utils.virt_common import libvirt, libvirt_available
+from ansible.module_utils.virt_common.connection import virt_open
+from ansible.module_utils.virt_common.facts import facts_collect
+
+
+class InventoryModule(BaseInventoryPlugin):
+    NAME = 'virt_domains'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and \
+            path.endswith(('virt_domains.yml', 'virt_domains.yaml'))
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+        if not libvirt_available():
+            raise AnsibleParserError("'libvirt' python library is missing.")
+
+        for hv in self.get_option('hypervisors'):
+            if not isinstance(hv, dict):
+                hv = dict(uri=hv)
+            uri = hv['uri']
+
+            def connect():
+                return virt_open(uri, readonly=True,
+                                 broker=self.get_option('broker'))
+            try:
+                domains, _ = facts_collect(
+                    uri, connect, self.get_option('cache_dir'),
+                    self.get_option('cache_ttl') if cache else 0,
+                    self.get_option('xml'))
+            except libvirt.libvirtError as e:
+                raise AnsibleParserError("fetching domains of %s failed: %s"
+                                         % (uri, e))
+
+            for name, facts in sorted(domains.items()):
+                self.inventory.add_host(name)
+                self.inventory.set_variable(name, 'virt_uri', uri)
+                self.inventory.set_variable(name, 'virt_uuid', facts['uuid'])
+                self.inventory.set_variable(name, 'virt_state',
+                                            facts['state'])
+                self.inventory.set_variable(name, 'virt_facts', facts)
+                group = self.inventory.add_group('virt_' + facts['state'])
+                self.inventory.add_child(group, name)
+                if hv.get('group'):
+                    group = self.inventory.add_group(hv['group'])
+                    self.inventory.add_child(group, name)
@@ -1,121 +1,34 @@
 #!/usr/bin/env python
 
-try:
-    import libvirt
-except ImportError:
-    installed_libvirt_py = False
-else:
-    installed_libvirt_py = True
-
 import re  # to handle whitespace
-import xml.etree.ElementTree as ET
+import copy
 import functools
+import collections
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.virt_common import libvirt, ET
+from ansible.module_utils.virt_common.connection import virt_connect, \
+    virt_open, lookup
+from ansible.module_utils.virt_common.state import dom_state, \
+    event_loop_start, monotonic, wait_for
+from ansible.module_utils.virt_common.xmlutil import xml_diff, \
+    xml_changed, xml_apply_edits, xml_edit_format, xml_edit_key, \
+    xml_digest, xml_normalize_units, xml_rules
+from ansible.module_utils.virt_common.timing import module_timings, \
+    no_timings
 # from ansible.module_utils._text import to_native  # FIXME: use it
 
 
-def xml_by_tag_and_text(e):
-    """ returns dict of (tag -> list of tags) in e. """
-    r = {}
-    for i in e:
-        if i.tag not in r:
-            r[i.tag] = []
-        r[i.tag] += [i]
-    return r
-
-
-def xml_text(e):
-    """ gets all direct text inside element """
-    t = e.text.strip() if e.text else ""  # text summary
-    for i in e:
-        t += i.tail.strip() if i.tail else ""
-        i.tail = ""  # remove tail since we aggregate in l.text!
-    e.text = t
-    return t
-
-ign=""
-
-def xml_cmp(left, right, alter=True, ignores={}):
-    ''' if alter is given: report change by returning false AND alter right
-    tree. otherwise just return false if a alteration of the right tree would
-    be needed. '''
-    global ign
-    assert left.tag == right.tag
-    ret = True
-
-    my_ignores = ignores[left.tag] if left.tag in ignores else {}
-
-    # parse attribute equality
-    attr_add = {}
-    for lk, lv in left.attrib.iteritems():
-        if lk not in right.attrib or right.attrib[lk] != lv:
-            if alter:
-                right.set(lk, lv)
-            if alter:  # FIXME integrate below
-                ret = False
-            if lk not in my_ignores: # ignore certain matches
-                ret = False
-            else:
-                ign+="IGNORED l:"+lk+"="+lv+";"
-
-    # sort elements by tag on each side
-    l_by_tag = xml_by_tag_and_text(left)
-    r_by_tag = xml_by_tag_and_text(right)
-
-    # collect text content in l_text and r_text. this also manipulates
-    # left.text and right.text to avoid dealing with text between elements
-    # while altering text contents of elements. this also means text always
-    # appears in front of tree.
-    l_text = xml_text(left)
-    r_text = xml_text(right)
-
-    # compare text
-    if l_text != r_text:
-        if my_ignores is not True:
-            ret = False
-        else:
-            ign+="IGNORED: "+l_text+" on "+left.tag
-        if alter:
-            right.text = l_text
-
-
-    for l in left:
-        if (len(l_by_tag[l.tag]) == 1 and l.tag in r_by_tag and
-                len(r_by_tag[l.tag]) == 1):
-            # 1:1 tag match so alter this element instead of adding a new one
-            ret = xml_cmp(l, r_by_tag[l.tag][0], alter, my_ignores) and ret
-        else:
-            # got multiple elements: compare but don't alter each one first.
-            # After this add elements to the right side which could not be
-            # matched. this also adds left elements missing on right side.
-            # TODO: match each element just once! (remove best match?)
-            for r in r_by_tag[l.tag] if l.tag in r_by_tag else []:
-                if xml_cmp(l, r, False, my_ignores): # found match
-                    # apply changes on previously ignored attributes first
-                    ret = xml_cmp(l, r, True, my_ignores) and ret
-                    break
-            else: # none found: append whole subtree
-                ret = False
-                if alter:  # notice: iterating over r_by_tag not right!
-                    right.append(l)
-    return ret
-
-
-def xml_sections(left, right, sections):
-    return False
-
-
 # created: running but not defined! (intermediate) FIXME
 # absent: equals undefined
 # present: in any state not being undefined
 # latest: in any state not being undefined keeping syntax up to date
-# saved: state is defined (not running) and there is a savefile present TODO
+# saved: state is defined (not running) and there is a managed save image
 # rebooted? (Maybe, shutdown and start work also. :-/)
 
 all_states_neg = ['absent', 'undefined']
 all_states_soft = ['present', 'latest']
-all_states_pos_real = ['defined', 'running', 'paused']
+all_states_pos_real = ['defined', 'running', 'paused', 'saved']
 all_states_pos = all_states_soft + all_states_pos_real
 all_states = all_states_neg + all_states_pos
 
@@ -133,43 +46,23 @@ def hard_state(state, default):
         return default if default in all_states_pos_real else 'defined'
 
 
-def dom_state(domain):
-    ''' receives state of domain by domain handle. If a falsey domain handle
-        is given (e.g. None) state 'unknown' is emitted.
-        returns: Tuple of (state, strange), where state is the domains state
-            and strange is True if libvirt returns a state like 'blocked' or
-            'pmsuspended'. However, those states should never appear. '''
-
-    # notice that there is no "undefined" state returned here since that
-    # causes the domain to be nonexistent.
-    states = {
-        libvirt.VIR_DOMAIN_NOSTATE: ('running', True),
-        libvirt.VIR_DOMAIN_BLOCKED: ('running', True),
-        libvirt.VIR_DOMAIN_RUNNING: ('running', False),
-        libvirt.VIR_DOMAIN_PAUSED: ('paused', False),
-        libvirt.VIR_DOMAIN_SHUTDOWN: ('defined', False),
-        libvirt.VIR_DOMAIN_SHUTOFF: ('defined', False),
-        libvirt.VIR_DOMAIN_CRASHED: ('unknown', True),
-        libvirt.VIR_DOMAIN_PMSUSPENDED: ('unknown', True),
-    }
-
-    if not domain:
-        return 'undefined', False
-
-    dom_state, _ = domain.state()  # get domain state from libvirt
-    return states.get(dom_state, ('unknown', True))
-
-
 class virt_domain(object):
-    def __init__(self, domain_handle, conn, xml, wait):
+    def __init__(self, domain_handle, conn, xml, wait, bypass_cache=False,
+                 save_format=None):
         self.domain_handle = domain_handle
         self.conn = conn
         self.xml = xml
         self.wait = wait
+        # options of managed save and restore
+        self.bypass_cache = bypass_cache
+        self.save_format = save_format
+        # all transitions share one deadline
+        self.deadline = monotonic() + wait
 
     def create(self):
-        # FIXME: implement wait (state=running)
         self.domain_handle = self.conn.createXML(self.xml)  # TODO: Test
+        if self.wait and self.domain_handle:
+            return self._wait(libvirt.VIR_DOMAIN_RUNNING)
         return self.domain_handle
 
     def define(self):  # TODO: Test (+ state)
@@ -179,231 +72,814 @@ class virt_domain(object):
     def undefine(self):
         return not self.domain_handle.undefine()  # TODO: Test (+ state)
 
-    def start(self):
-        # FIXME: implement wait (state=running)
-        res = not self.domain_handle.create()
+    def start(self):  # restores a managed save image if there is one
+        if self.bypass_cache:
+            res = not self.domain_handle.createWithFlags(
+                libvirt.VIR_DOMAIN_START_BYPASS_CACHE)
+        else:
+            res = not self.domain_handle.create()
+        if self.wait and res:
+            return self._wait(libvirt.VIR_DOMAIN_RUNNING)
         return res  # TODO: Test
 
     def _wait(self, target):
-        # TODO: check if state from array applies?
-        while True:  # FIXME: count and evaluate duration (self.wait)
+        """ waits for the domain to reach libvirt state target until the
+        deadline. A domain which vanished (transient) counts as shut off.
+        returns False on timeout. """
+        def reached():
             try:
-                r = self.domain_handle.state()[0]
+                return self.domain_handle.state()[0] == target
             except libvirt.libvirtError as e:
-                if(e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN):
-                    return True
-            if r == target:
-                return True
+                if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                    raise
+                return target == libvirt.VIR_DOMAIN_SHUTOFF
+        return wait_for(self.conn, self.domain_handle, reached,
+                        self.deadline - monotonic())
 
     def shutdown(self):
         r = self.domain_handle.shutdown()
-        if self.wait:
-            self._wait(libvirt.VIR_DOMAIN_SHUTOFF)
+        if self.wait and not r:
+            return self._wait(libvirt.VIR_DOMAIN_SHUTOFF)
         return not r
 
     def destroy(self):
         r = self.domain_handle.destroy()
-        if self.wait:
-            self._wait(libvirt.VIR_DOMAIN_SHUTOFF)
+        if self.wait and not r:
+            return self._wait(libvirt.VIR_DOMAIN_SHUTOFF)
         return not r
 
     def pause(self):
-        # FIXME: implement wait (state=?)
-        return self.domain_handle.suspend()  # TODO: Test
+        r = self.domain_handle.suspend()  # TODO: Test
+        if self.wait and not r:
+            return self._wait(libvirt.VIR_DOMAIN_PAUSED)
+        return not r
 
     def resume(self):
-        # FIXME: implement wait (state=?)
-        return self.domain_handle.resume()  # TODO: Test
+        r = self.domain_handle.resume()  # TODO: Test
+        if self.wait and not r:
+            return self._wait(libvirt.VIR_DOMAIN_RUNNING)
+        return not r
+
+    def save(self):
+        flags = libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE if self.bypass_cache \
+            else 0
+        if self.save_format:
+            # saveParams without a file does a managed save
+            if not hasattr(self.domain_handle, 'saveParams'):
+                raise DomainError("libvirt does not support save_format.")
+            params = {getattr(libvirt, 'VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT',
+                              'image_format'): self.save_format}
+            r = self.domain_handle.saveParams(params, flags)
+        else:
+            r = self.domain_handle.managedSave(flags)
+        if self.wait and not r:
+            return self._wait(libvirt.VIR_DOMAIN_SHUTOFF)
+        return not r
 
+    def discard(self):
+        return not self.domain_handle.managedSaveRemove(0)
 
-def state_transition(current_state, target_state, transient=False,
-                     graceful=True):
-    assert(current_state != target_state)
 
-    # define the table of state transitions and functions to use
-    # function 'f' transitions from state 's' to state 'd'
+# transition from state 'source' to state 'dest' using method 'method' of
+# class virt_domain
+StateTransition = collections.namedtuple('StateTransition',
+                                         'source dest method')
+
+state_plans = {}  # (transient, graceful) -> {(from, to): transitions}
+
+
+def state_table(transient=False, graceful=True):
+    """ returns list of StateTransition which are possible for a domain """
     if transient:  # transient means a domain has no 'defined' state
-        trans = [{'s': "undefined", 'd': "running", 'f': virt_domain.create},
-                 {'s': "defined", 'd': "undefined", 'f': virt_domain.undefine}]
+        trans = [StateTransition("undefined", "running", "create"),
+                 StateTransition("defined", "undefined", "undefine")]
         off_target = "undefined"  # target state for shutdown
     else:
-        trans = [{'s': "undefined", 'd': "defined", 'f': virt_domain.define},
-                 {'s': "defined", 'd': "running", 'f': virt_domain.start},
-                 {'s': "defined", 'd': "undefined", 'f': virt_domain.undefine}]
+        trans = [StateTransition("undefined", "defined", "define"),
+                 StateTransition("defined", "running", "start"),
+                 StateTransition("defined", "undefined", "undefine")]
         off_target = "defined"
 
-    if graceful:  # don't kill the vm using destroy but use shutdown
-        trans += [{'s': "running", 'd': off_target, 'f': virt_domain.shutdown}]
-    else:
-        trans += [{'s': "running", 'd': off_target, 'f': virt_domain.destroy}]
-
-    # other states (paused and saved for later use)
-    trans += [{'s': "running", 'd': "paused", 'f': virt_domain.pause},
-              {'s': "paused", 'd': "running", 'f': virt_domain.resume}]
-#              {'s': "running", 'd': "saved", 'f': f_save},
-#              {'s': "saved", 'd': "running", 'f': f_restore},]
-
-    def find_state(st_from, st_to, t):
-        """ find path from state 'st_from' to state 'st_to' using transition
-        table 't'. returns list of dicts from 't' along path """
-        # function does converge, but I'm not sure its result is always correct
-
-        # first try to find direct transition
-        t_match = [x for x in t if st_from == x['s'] and st_to == x['d']]
-        if t_match:
-            return [t_match[0]]
-        else:  # there is no direct transition so find path between states
-            # t_0: all transitions which originate from state st_from
-            t_0 = [x for x in t if st_from == x['s']]
-
-            # t_n: new transition table which does not contain transitions
-            # originating from state st_from. generating this new transition
-            # table for further processing makes the algorithm terminate
-            # since we never reach the originating state again.
-            t_n = [x for x in t if st_from != x['s'] and st_from != x['d']]
-
-            # find transition paths from destination states in 't_n' which
-            # lead to 'st_to'. this is a recusion so we always get paths.
-            r = [[x] + find_state(x['d'], st_to, t_n)
-                 for x in t_0 if find_state(x['d'], st_to, t_n)]
-
-            return min(r, key=len) if r else []  # find minimal transition path
+    # don't kill the vm using destroy but use shutdown if graceful
+    trans += [StateTransition("running", off_target,
+                              "shutdown" if graceful else "destroy")]
+
+    # other states. transient domains can not be saved.
+    trans += [StateTransition("running", "paused", "pause"),
+              StateTransition("paused", "running", "resume")]
+    if not transient:
+        trans += [StateTransition("running", "saved", "save"),
+                  StateTransition("paused", "saved", "save"),
+                  StateTransition("saved", "running", "start"),
+                  StateTransition("saved", "defined", "discard")]
+    return trans
+
+
+def state_plans_for(transient=False, graceful=True):
+    """ returns dict of shortest transition paths between all pairs of
+    states. The table is built once per combination of options by a breadth
+    first search from each state. """
+    key = (transient, graceful)
+    if key not in state_plans:
+        edges = {}
+        for t in state_table(transient, graceful):
+            edges.setdefault(t.source, []).append(t)
+        plans = {}
+        for start in edges:
+            paths = {start: ()}
+            queue = collections.deque([start])
+            while queue:
+                s = queue.popleft()
+                for t in edges.get(s, []):
+                    if t.dest not in paths:
+                        paths[t.dest] = paths[s] + (t,)
+                        queue.append(t.dest)
+            for dest, path in paths.items():
+                if dest != start:
+                    plans[(start, dest)] = path
+        state_plans[key] = plans
+    return state_plans[key]
+
+
+def state_plan(current_state, target_state, transient=False, graceful=True):
+    """ returns tuple of StateTransition leading from current_state to
+    target_state on the shortest path. empty if there is no such path. """
+    return state_plans_for(transient, graceful).get(
+        (current_state, target_state), ())
+
+
+def state_transition(current_state, target_state, transient=False,
+                     graceful=True):
+    """ returns one (chained) function which transitions a virt_domain from
+    current_state to target_state or False if there is no path. """
+    assert(current_state != target_state)
 
     def chain(a, b):
         """ retuns a function which executes b(...) after a(...). """
         return lambda *args, **kwargs: \
             a(*args, **kwargs) and b(*args, **kwargs)
 
-    # return one (chained) function which transitions domain as defined
-    return functools.reduce(lambda x, y: chain(x, y['f']) if x else y['f'],
-                            find_state(current_state, target_state, trans),
-                            False)
+    return functools.reduce(
+        lambda x, y: chain(x, getattr(virt_domain, y.method)) if x
+        else getattr(virt_domain, y.method),
+        state_plan(current_state, target_state, transient, graceful), False)
 
 
-def eh_dummy(x, y):
-    """ dummy error handler to supress error messages to stderr """
-    pass
+# options which may be given per domain in bulk mode (parameter 'domains').
+# options not given for a domain default to the module parameters.
+domain_options = ['name', 'state', 'graceful', 'wait', 'latest', 'xml',
+                  'ignore', 'prune', 'sections', 'exclusive', 'hotplug',
+                  'bypass_cache', 'save_format', 'numa', 'io_profile',
+                  'duplicates', 'transient',
+                  'debug_out_path', 'fingerprint']
 
+# ignore rules applied in addition to those given by parameter 'ignore'
+default_ignores = ['devices/disk/boot@order', 'devices/interface/boot@order',
+                   'os/nvram']
 
-def main():
-    # domains in negative state can not be found
 
-    module = AnsibleModule(argument_spec=dict(
-        name=dict(aliases=['guest']),
-        state=dict(choices=all_states, default='present'),
-        graceful=dict(type='bool', default=True),  # use 'destroy' if false
-        wait=dict(type='int', default=0),
-        uri=dict(default='qemu:///system'),
-        latest=dict(type='bool', default=False),  # 'latest' regarless state
-        xml=dict(),
-        sections=dict(),
-        transient=dict(type='bool', default=False),  # TODO rename persistent?
-        debug_out_path=dict(),
-    ), supports_check_mode=True)
-    result = dict(changed=False, message='')
+class DomainError(Exception):
+    """ raised if converging a domain fails. 'kwargs' are passed along with
+    the message to fail_json. """
+    def __init__(self, msg, **kwargs):
+        super(DomainError, self).__init__(msg)
+        self.msg = msg
+        self.kwargs = kwargs
+
+
+# metadata element storing digests of the applied definition. 'applied' is
+# the digest of the desired definition given to the module, 'live' the digest
+# of the persistent definition libvirt made of it. 'learned' elements hold
+# keys of edits libvirt reverted when the definition got applied.
+metadata_uri = "https://github.com/thoto/ansible_virt_domain"
+metadata_prefix = "virtdomain"
+metadata_strip = re.compile(
+    r'\s*<%s:state\b.*?</%s:state>' % (metadata_prefix, metadata_prefix),
+    re.S)
+metadata_empty = re.compile(r'\s*<metadata>\s*</metadata>|\s*<metadata/>')
+
+# parameters whose values make up the desired definition
+digest_options = ['xml', 'ignore', 'prune', 'sections', 'exclusive', 'numa',
+                  'io_profile']
+
+
+def definition_digest(params):
+    """ returns digest of all parameters describing the desired definition """
+    return xml_digest(repr([params.get(k) for k in digest_options]))
 
-    if not installed_libvirt_py:
-        module.fail_json(msg="'libvirt' python library is missing on host.")
 
-    libvirt.registerErrorHandler(eh_dummy, 'ctx')  # apply dummy error handler
+def live_digest(domain_handle):
+    """ returns digest of the persistent definition of the domain leaving out
+    the metadata element of this module. The document is not parsed. """
+    xml = domain_handle.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+    return xml_digest(metadata_empty.sub('', metadata_strip.sub('', xml)))
 
-    # connect to libvirt host
-    conn = libvirt.open(module.params['uri']) if not module.check_mode else \
-        libvirt.openReadOnly(module.params['uri'])
-    if not conn:
-        module.fail_json(msg="connection to libvirt failed.")
 
-    # find domain
-    domain_handle = None
+def metadata_read(domain_handle):
+    """ returns dict of digests ('applied', 'live') and list of learned edit
+    keys ('learned') stored at the domains metadata. """
+    meta = dict(learned=[])
     try:
-        domain_handle = conn.lookupByName(module.params['name'])
+        xml = domain_handle.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                                     metadata_uri,
+                                     libvirt.VIR_DOMAIN_AFFECT_CONFIG)
     except libvirt.libvirtError as e:
-        if(e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN):
-            module.fail_json(msg=str(e), debug=e.get_error_code())
+        if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN_METADATA:
+            raise
+        return meta
+    for e in ET.fromstring(xml):
+        tag = e.tag.split('}')[-1]  # strip namespace
+        if tag == 'learned':
+            meta['learned'].append(e.text or "")
+        else:
+            meta[tag] = e.text
+    return meta
+
+
+def metadata_write(domain_handle, applied, learned):
+    """ stores digest of applied definition and the resulting persistent
+    definition as well as learned edit keys at the domains metadata. """
+    root = ET.Element('state')
+    ET.SubElement(root, 'applied').text = applied
+    ET.SubElement(root, 'live').text = live_digest(domain_handle)
+    for key in learned:
+        ET.SubElement(root, 'learned').text = key
+    domain_handle.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                              ET.tostring(root).decode('utf-8'),
+                              metadata_prefix, metadata_uri,
+                              libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+
+
+def xml_current(domain_handle, timings=no_timings):
+    """ returns normalized persistent definition of the domain. The inactive
+    definition leaves out runtime state like aliases and expanded cpu models
+    which must not be written back using defineXML. """
+    with timings.phase('xml_desc'):
+        xml = domain_handle.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+    with timings.phase('parse'):
+        return xml_normalize_units(ET.fromstring(xml))
+
+
+def domain_rules(params):
+    """ returns compiled comparison rules given by params """
+    try:
+        return xml_rules(default_ignores + list(params.get('ignore') or []),
+                         params.get('prune') or [],
+                         params.get('sections') or [],
+                         params.get('exclusive') or [])
+    except ValueError as e:
+        raise DomainError(str(e))
+
+
+def xml_transform(conn, domain_handle, params, xml_def, xml_curr=None,
+                  timings=no_timings):
+    """ completes the desired definition xml_def before comparing it: adds
+    vcpu pinning and NUMA placement computed from the host topology unless
+    the current definition xml_curr pins vcpus already ('numa') and I/O
+    tuning of disks and interfaces ('io_profile'). raises DomainError if
+    the host lacks free cpus. """
+    if params.get('numa') and (xml_curr is None or
+                               xml_curr.find('cputune/vcpupin') is None):
+        from ansible.module_utils.virt_common.numa import numa_merge
+        with timings.phase('numa'):
+            try:
+                numa_merge(conn, xml_def, domain_handle.UUIDString()
+                           if domain_handle else None)
+            except ValueError as e:
+                raise DomainError(str(e))
+    if params.get('io_profile'):
+        from ansible.module_utils.virt_common.ioprofile import io_profile
+        with timings.phase('io_profile'):
+            io_profile(conn, xml_def)
+
+
+# change applied to an active domain by calling method 'action' of virDomain
+# with 'args' and flags (names of libvirt constants) 'flags'. 'edits' are the
+# edits of the edit script it covers. if 'config' is False the persistent
+# definition has to be redefined to contain the edits.
+LiveChange = collections.namedtuple('LiveChange',
+                                    'action args flags edits config')
+
+# devices are changed in both the running domain and its persistent config
+device_flags = ['VIR_DOMAIN_AFFECT_LIVE', 'VIR_DOMAIN_AFFECT_CONFIG']
+
+
+def device_changes(xml_curr, edits):
+    """ splits edit script on tree xml_curr into a list of LiveChange
+    attaching, detaching or updating single devices and a list of remaining
+    edits. """
+    devices = [i for i, e in enumerate(xml_curr) if e.tag == 'devices']
+    units = collections.OrderedDict()  # key -> edits of one device
+    rest = []
+    for e in edits:
+        if not devices or e.path[:1] != (devices[0],) or \
+                (len(e.path) == 1 and e.op != 'append'):
+            rest.append(e)
+        elif len(e.path) == 1:
+            units[('attach', id(e))] = [e]
+        elif e.op == 'remove' and len(e.path) == 2:
+            units[('detach', e.path)] = [e]
+        else:
+            units.setdefault(('update', e.path[:2]), []).append(e)
+
+    changes = []
+    for (kind, key), unit in units.items():
+        if not xml_changed(unit):
+            rest.extend(unit)  # ignored edits are applied along a define
+            continue
+        if kind == 'attach':
+            action, dev = 'attachDeviceFlags', unit[0].value
+        elif kind == 'detach':
+            action, dev = 'detachDeviceFlags', unit[0].value
+        else:
+            action = 'updateDeviceFlags'
+            dev = xml_apply_edits(copy.deepcopy(xml_curr[key[0]][key[1]]),
+                                  [e._replace(path=e.path[2:]) for e in unit])
+        changes.append(LiveChange(action,
+                                  (ET.tostring(dev).decode('utf-8'),),
+                                  device_flags, unit, True))
+    return changes, rest
+
+
+def xml_count(root, tag, attr=None):
+    """ returns integer given by text (or attribute attr) of child tag of
+    root. sizes have to be given in KiB. None if missing or malformed. """
+    e = root.find(tag)
+    if e is None or e.get('unit', 'KiB') != 'KiB':
+        return None
+    value = e.get(attr) if attr else e.text
+    try:
+        return int(value.strip())
+    except (AttributeError, ValueError):
+        return None
+
+
+# resource elements which can be changed live and their attributes
+resource_attrs = {'memory': ['unit'], 'currentMemory': ['unit'],
+                  'vcpu': ['current']}
+
+
+def resource_changes(domain_handle, xml_def, xml_curr, edits):
+    """ splits edit script into a list of LiveChange of memory size (balloon)
+    and vcpu count of an active domain within its current maximums and a list
+    of remaining edits. Memory and vcpus are changed live only, their
+    persistent configuration is redefined. """
+    tags = [e.tag for e in xml_curr]
+    units = {}  # resource tag -> edits
+    rest = []
+    for e in edits:
+        tag = tags[e.path[0]] if len(e.path) == 1 else None
+        if tag in resource_attrs and (e.op == 'text' or e.op == 'attr' and
+                                      e.key in resource_attrs[tag]):
+            units.setdefault(tag, []).append(e)
+        else:
+            rest.append(e)
+
+    changes = []
+    memory = units.pop('memory', []) + units.pop('currentMemory', [])
+    if xml_changed(memory):
+        maximum = xml_count(xml_def, 'memory')
+        target = xml_count(xml_def, 'currentMemory') or maximum
+        memory = resource_change(changes, 'setMemoryFlags', memory, target,
+                                 maximum, domain_handle.maxMemory(),
+                                 lambda e: tags[e.path[0]] == 'memory')
+    rest.extend(memory)
+
+    vcpu = units.pop('vcpu', [])
+    if xml_changed(vcpu):
+        maximum = xml_count(xml_def, 'vcpu')
+        target = xml_count(xml_def, 'vcpu', 'current') or maximum
+        live_max = domain_handle.vcpusFlags(
+            libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+        vcpu = resource_change(changes, 'setVcpusFlags', vcpu, target,
+                               maximum, live_max, lambda e: e.op == 'text')
+    rest.extend(vcpu)
+    return changes, rest
+
+
+def resource_change(changes, action, edits, target, maximum, live_max,
+                    is_maximum):
+    """ appends LiveChange setting resource to target using method action
+    to changes if target is within live_max. edits changing the maximum
+    (is_maximum) beyond live_max are left out. returns edits not covered. """
+    if not target or target > live_max:
+        return edits
+    rest = []
+    if not maximum or maximum > live_max:
+        rest = [e for e in edits if is_maximum(e)]
+        edits = [e for e in edits if not is_maximum(e)]
+    changes.append(LiveChange(action, (target,), ['VIR_DOMAIN_AFFECT_LIVE'],
+                              edits, False))
+    return rest
+
+
+def live_apply(domain_handle, changes):
+    """ applies list of LiveChange to an active domain. returns list of
+    edits of changes libvirt refused to apply live. """
+    failed = []
+    for c in changes:
+        flags = functools.reduce(lambda a, f: a | getattr(libvirt, f),
+                                 c.flags, 0)
+        try:
+            getattr(domain_handle, c.action)(*(c.args + (flags,)))
+        except libvirt.libvirtError:
+            failed.extend(c.edits)
+    return failed
+
+
+def edit_script(xml_def, xml_curr, rules, learned=(), timings=no_timings):
+    """ returns edit script turning xml_curr into xml_def. edits libvirt
+    reverted when they got applied before (keys in learned) are ignored. """
+    with timings.phase('diff'):
+        edits = xml_diff(xml_def, xml_curr, rules)
+        learned = set(learned)
+        if learned:
+            edits = [e._replace(ignored=True) if not e.ignored and
+                     xml_edit_key(xml_curr, e) in learned else e
+                     for e in edits]
+    return edits
+
+
+def learn_reverted(domain_handle, xml_def, rules, timings=no_timings):
+    """ returns keys of edits libvirt reverted when defining xml_def by
+    comparing it to the resulting persistent definition. Those edits are
+    ignored on later runs to not redefine the domain each time. """
+    xml_new = xml_current(domain_handle, timings)
+    with timings.phase('diff'):
+        return sorted(xml_edit_key(xml_new, e)
+                      for e in xml_diff(xml_def, xml_new, rules)
+                      if not e.ignored)
+
+
+def peer_index(params):
+    """ returns index of domains defined on params['peers'] (see
+    location_index) """
+    from ansible.module_utils.virt_common.location import location_index
+    return location_index(
+        dict((uri, uri) for uri in params['peers']),
+        lambda uri: virt_open(uri, readonly=True, broker=params['broker']))
+
+
+def resolve_duplicate(name, params, uri, index, check_mode=False):
+    """ handles domain 'name' which is not defined on this hypervisor but
+    maybe on peers listed by index. Depending on params['duplicates'] this
+    fails or migrates the domain to uri. returns tuple of the migrated domain
+    (None if not migrated) and result dict. """
+    owners = index.get(name, [])
+    if not owners or params['duplicates'] == 'ignore':
+        return None, {}
+    peers = sorted(hv for hv, _ in owners)
+    if params['duplicates'] == 'fail' or len(owners) > 1:
+        raise DomainError("domain is defined on other hypervisors.",
+                          peers=peers)
+    peer, facts = owners[0]
+    result = dict(changed=True, migrated_from=peer)
+    if check_mode:
+        return None, result
+
+    # live migration if running, the definition is moved in any case
+    flags = libvirt.VIR_MIGRATE_PERSIST_DEST | \
+        libvirt.VIR_MIGRATE_UNDEFINE_SOURCE
+    if facts['state'] in ('running', 'paused'):
+        flags |= libvirt.VIR_MIGRATE_LIVE
+    else:
+        flags |= libvirt.VIR_MIGRATE_OFFLINE
+    source = virt_open(peer, broker=False).lookupByName(name)
+    return source.migrate3(virt_open(uri, broker=False), {}, flags), result
+
+
+def converge(conn, domain_handle, params, check_mode=False, diff=False,
+             timings=no_timings):
+    """ brings domain 'domain_handle' (None if not defined) into the state
+    described by params. returns result dict, raises DomainError on failure.
+    durations of phases are added to timings. """
+    result = dict(changed=False)
 
     # evaluate domain state ... first get current state
-    current_state, strange_state = dom_state(domain_handle)
+    with timings.phase('state'):
+        current_state, strange_state = dom_state(domain_handle)
     if current_state == 'undefined' \
-            and module.params['state'] not in all_states_neg \
-            and not ('xml' in module.params and module.params['xml']):
-        module.fail_json(msg="domain not found and no definition given.")
+            and params['state'] not in all_states_neg \
+            and not params.get('xml'):
+        raise DomainError("domain not found and no definition given.")
 
     # find out what state the user wants the domain to be in
-    desired_state = hard_state(module.params['state'], default=current_state)
-    if module.params['transient'] and desired_state == "defined":
-        module.fail_json(msg="transient domain can not be defined.")
-
-    # xml defined at parameters
-    xml_def = ET.fromstring(module.params['xml']) \
-        if 'xml' in module.params and module.params['xml'] else None
-    if xml_def: # FIXME Future warning here
-        result['defined_xml'] = ET.tostring(xml_def)  # FIXME: remove!
-    # current domain definition (via dumpxml)
-    xml_curr = ET.fromstring(domain_handle.XMLDesc(0)) \
-        if domain_handle else None
-    if xml_curr:
-        result['current_xml'] = ET.tostring(xml_curr)  # FIXME: remove!
+    desired_state = hard_state(params['state'], default=current_state)
+    if params['transient'] and desired_state == "defined":
+        raise DomainError("transient domain can not be defined.")
+
+    # digest of the desired definition is stored at persistent domains to
+    # skip parsing and comparing unchanged definitions on later runs.
+    digest = None
+    meta = dict(learned=[])
+    if params.get('xml') and not params['transient'] \
+            and desired_state != 'undefined':
+        digest = definition_digest(params)
+        if domain_handle:
+            with timings.phase('metadata'):
+                meta = metadata_read(domain_handle)
+
+    # xml defined at parameters and current domain definition (via dumpxml)
+    # are parsed only if needed.
+    xml_def = None
+    xml_curr = None
     # xml to be applied by module
     xml_apply = None
-
-    ignores = {
-            "domain": {
-                "devices": {
-                    "disk": { "boot": { "order": True } },
-                    "interface": { "boot": { "order": True } }
-                    },
-                "os": {"nvram": True }
-                }
-            }
+    # changes of devices applied to the active domain without redefining it
+    live = []
+    # whether the domain is redefined after applying live changes
+    redefine = False
 
     # parse xml and find difference if 'latest' is specified
     if current_state == 'undefined' and current_state != desired_state:
         # there is no previous XML given, so apply xml definition
-        if 'sections' in module.params and module.params['sections']:
-            xml_sections(xml_def, None, module.params['sections'])
-        xml_apply = ET.tostring(xml_def)
-    elif module.params['state'] == 'latest' or module.params['latest']:
+        with timings.phase('parse'):
+            xml_def = xml_normalize_units(ET.fromstring(params['xml']))
+        xml_transform(conn, None, params, xml_def, timings=timings)
+        xml_apply = ET.tostring(xml_def).decode('utf-8')
+    elif params['state'] == 'latest' or params['latest']:
         # calculate difference of currently running xml and desired xml
-        if not (('xml' in module.params and module.params['xml']) or
-                ('sections' in module.params and module.params['sections'])):
-            module.fail_json(msg="neither XML nor sections were defined " +
-                                 "but state should be latest.")
-
-        if 'sections' in module.params and module.params['sections']:
-            result['changed'] = \
-                xml_sections(xml_def, xml_curr, module.params['sections']) \
-                or result['changed']
-        if 'xml' in module.params and module.params['xml']:
-            xml_same = xml_cmp(xml_def, xml_curr, True, ignores)
-            result['tree'] = ET.tostring(xml_curr)
-            if not xml_same:
+        if not params.get('xml'):
+            raise DomainError("no XML defined but state should be latest.")
+        rules = domain_rules(params)
+        # same keys whether the definitions got compared or not
+        result.update(edits=[], ignored_parts=[], tree=None)
+
+        with timings.phase('xml_desc'):
+            unchanged = digest and params['fingerprint'] != 'off' and \
+                meta.get('applied') == digest and \
+                (params['fingerprint'] == 'trust' or
+                 meta.get('live') == live_digest(domain_handle))
+        if unchanged:
+            result['fingerprint'] = 'unchanged'
+        else:
+            with timings.phase('parse'):
+                xml_def = xml_normalize_units(ET.fromstring(params['xml']))
+            # FIXME: remove defined_xml and current_xml!
+            result['defined_xml'] = ET.tostring(xml_def).decode('utf-8')
+            xml_curr = xml_current(domain_handle, timings)
+            result['current_xml'] = ET.tostring(xml_curr).decode('utf-8')
+            xml_transform(conn, domain_handle, params, xml_def, xml_curr,
+                          timings)
+
+        if not unchanged:
+            edits = edit_script(xml_def, xml_curr, rules, meta['learned'],
+                                timings)
+            result['ignored_parts'] = [xml_edit_format(xml_curr, e)
+                                       for e in edits if e.ignored]
+            if xml_changed(edits):
                 result['changed'] = True
-        xml_apply = ET.tostring(xml_curr)
+                result['edits'] = [xml_edit_format(xml_curr, e)
+                                   for e in edits if not e.ignored]
+                if diff:
+                    result['diff'] = dict(
+                        prepared="\n".join(result['edits']) + "\n")
+                # device, memory and vcpu changes of active domains are
+                # applied live. edits which can not be applied live take
+                # effect after a restart.
+                rest = edits
+                active = current_state == desired_state and \
+                    current_state in ('running', 'paused')
+                if params['hotplug'] and active:
+                    live, rest = device_changes(xml_curr, edits)
+                    resize, rest = resource_changes(domain_handle, xml_def,
+                                                    xml_curr, rest)
+                    live += resize
+                    result['live'] = [xml_edit_format(xml_curr, e)
+                                      for c in live for e in c.edits
+                                      if not e.ignored]
+                if active:
+                    result['restart'] = [xml_edit_format(xml_curr, e)
+                                         for e in rest if not e.ignored]
+                    result['restart_required'] = xml_changed(rest)
+                if live and (xml_changed(rest) or
+                             not all(c.config for c in live)):
+                    redefine = True  # after applying the live changes
+                elif xml_changed(rest):
+                    xml_apply = ET.tostring(xml_apply_edits(
+                        xml_curr, edits)).decode('utf-8')
+            result['tree'] = ET.tostring(xml_curr).decode('utf-8')
 
     # calculate state transition
-    method = None
+    plan = ()
     if current_state != desired_state:
         result['changed'] = True
-        method = state_transition(current_state, desired_state,
-                                  transient=module.params['transient'],
-                                  graceful=module.params['graceful'])
-
-    if not module.check_mode and result['changed']:
+        plan = state_plan(current_state, desired_state,
+                          transient=params['transient'],
+                          graceful=params['graceful'])
+        if not plan:
+            raise DomainError("no transition from state %s to %s." %
+                              (current_state, desired_state))
+        result['plan'] = [dict(zip(t._fields, t)) for t in plan]
+
+    if not check_mode and result['changed']:
+        with timings.phase('live'):
+            failed = live_apply(domain_handle, live)
+        if failed:  # fall back to redefining the domain
+            failed = [xml_edit_format(xml_curr, e)
+                      for e in failed if not e.ignored]
+            result['live'] = [e for e in result['live'] if e not in failed]
+            result['restart'] += failed
+            result['restart_required'] = True
+            redefine = True
+        if redefine:
+            # devices attached live got details like MAC addresses assigned
+            # by libvirt in their config, so the persistent definition is
+            # compared again instead of writing back the one read before
+            xml_curr = xml_current(domain_handle, timings)
+            xml_apply = ET.tostring(xml_apply_edits(xml_curr, edit_script(
+                xml_def, xml_curr, rules, meta['learned'], timings))
+            ).decode('utf-8')
         if xml_apply and not current_state == "undefined":
-            if 'debug_out_path' in module.params \
-                    and module.params['debug_out_path']:
-                with open(module.params['debug_out_path'],'w') as f:
+            if params.get('debug_out_path'):
+                with open(params['debug_out_path'], 'w') as f:
                     f.write(xml_apply)
-            conn.defineXML(xml_apply)
-        if method:
+            with timings.phase('define'):
+                conn.defineXML(xml_apply)
+        if plan:
             vd = virt_domain(domain_handle, conn, xml=xml_apply,
-                             wait=module.params['wait'])
-            st_result = method(vd)
-            if not st_result:
-                module.fail_json(msg="transitioning between states failed.",
-                                 res=st_result)
-    global ign
-    result['ignored_parts']=ign
+                             wait=params['wait'],
+                             bypass_cache=params['bypass_cache'],
+                             save_format=params['save_format'])
+            for t in plan:
+                with timings.phase('transition:%s' % t.method):
+                    st_result = getattr(vd, t.method)()
+                if not st_result:
+                    raise DomainError("transitioning between states failed.",
+                                      res=st_result, transition=t.method)
+            domain_handle = vd.domain_handle
+
+    # record digests whenever the definition was applied or compared due to
+    # a digest mismatch. after applying learn what libvirt reverted.
+    if not check_mode and digest and xml_def is not None and \
+            (xml_apply or meta.get('applied') != digest or
+             params['fingerprint'] != 'off'):
+        learned = meta['learned']
+        if xml_apply:
+            learned = learn_reverted(domain_handle, xml_def,
+                                     domain_rules(params), timings)
+            if learned:
+                result['learned'] = learned
+        with timings.phase('metadata'):
+            metadata_write(domain_handle, digest, learned)
+    return result
+
+
+def main():
+    # domains in negative state can not be found
+
+    argument_spec = dict(
+        name=dict(aliases=['guest']),
+        state=dict(choices=all_states, default='present'),
+        graceful=dict(type='bool', default=True),  # use 'destroy' if false
+        wait=dict(type='int', default=0),
+        uri=dict(default='qemu:///system'),
+        broker=dict(type='bool', default=True),  # use connection broker
+        latest=dict(type='bool', default=False),  # 'latest' regarless state
+        xml=dict(),
+        # selectors like 'devices/interface/boot@order' or 'os/nvram' of
+        # attributes and elements whose differences are ignored, elements
+        # not to compare at all and sections which are compared exclusively
+        ignore=dict(type='list', default=[]),
+        prune=dict(type='list', default=[]),
+        sections=dict(type='list', default=[]),
+        # elements like 'devices/interface' removed unless defined by xml
+        exclusive=dict(type='list', default=[]),
+        # apply device, memory and vcpu changes to running domains live
+        hotplug=dict(type='bool', default=True),
+        # managed save and restore bypassing the file system cache, format
+        # of the save image (e.g. 'zstd') instead of the one of qemu.conf
+        bypass_cache=dict(type='bool', default=False),
+        save_format=dict(),
+        # pin vcpus and memory of domains not pinned yet to the least loaded
+        # NUMA cells of the host, skipping cpus pinned by other domains
+        numa=dict(type='bool', default=False),
+        # fill in cache, io, discard and iothreads of disks by their storage
+        # and vhost queues of virtio interfaces by the number of vcpus
+        io_profile=dict(type='bool', default=False),
+        transient=dict(type='bool', default=False),  # TODO rename persistent?
+        debug_out_path=dict(),
+        # return durations of phases as 'timings', write cProfile statistics
+        timings=dict(type='bool', default=False),
+        profile_out_path=dict(),
+        # URIs of other hypervisors which are checked for domains not defined
+        # here. those domains are refused ('fail') or migrated here.
+        peers=dict(type='list', default=[]),
+        duplicates=dict(choices=['fail', 'migrate', 'ignore'],
+                        default='fail'),
+        # skip comparing definitions if digests stored at the domain match.
+        # 'verify' still reads the persistent definition (without parsing
+        # it) to notice changes made elsewhere, 'trust' does not read it.
+        fingerprint=dict(choices=['verify', 'trust', 'off'],
+                         default='verify'),
+    )
+    # bulk mode: list of per domain options, typed like the module parameters.
+    # options have no defaults to tell those not given (None) from others.
+    options = dict((k, dict((a, v) for a, v in argument_spec[k].items()
+                            if a != 'default')) for k in domain_options)
+    options['name']['required'] = True
+    argument_spec['domains'] = dict(type='list', elements='dict',
+                                    options=options)
+    module = AnsibleModule(argument_spec=argument_spec,
+                           supports_check_mode=True,
+                           mutually_exclusive=[['name', 'domains']],
+                           required_one_of=[['name', 'domains']])
+    result = dict(changed=False, message='')
+    timings = module_timings(module)
+
+    # per domain options got validated and converted by AnsibleModule
+    specs = []
+    for item in module.params['domains'] or []:
+        spec = dict((k, module.params[k]) for k in domain_options)
+        spec.update((k, v) for k, v in item.items() if v is not None)
+        specs.append(spec)
+
+    # event loop has to be registered before connecting
+    wait = not module.check_mode and \
+        any(spec['wait'] for spec in specs or [module.params])
+    with timings.phase('open'):
+        conn = virt_connect(module, readonly=module.check_mode,
+                            before_open=event_loop_start if wait else None)
+
+    if not specs:
+        # find domain
+        try:
+            with timings.phase('lookup'):
+                domain_handle = lookup(conn.lookupByName,
+                                       module.params['name'],
+                                       libvirt.VIR_ERR_NO_DOMAIN)
+        except libvirt.libvirtError as e:
+            module.fail_json(msg=str(e), debug=e.get_error_code())
+
+        try:
+            migrated = {}
+            if not domain_handle and module.params['peers'] and \
+                    module.params['state'] not in all_states_neg:
+                with timings.phase('peers'):
+                    domain_handle, migrated = resolve_duplicate(
+                        module.params['name'], module.params,
+                        module.params['uri'], peer_index(module.params),
+                        module.check_mode)
+                if module.check_mode and migrated:
+                    module.exit_json(**timings.report(migrated))
+            result.update(converge(conn, domain_handle, module.params,
+                                   module.check_mode, module._diff, timings))
+            result.update(migrated)
+        except DomainError as e:
+            module.fail_json(msg=e.msg, **timings.report(e.kwargs))
+        except libvirt.libvirtError as e:
+            module.fail_json(msg=str(e), debug=e.get_error_code(),
+                             **timings.report({}))
+        module.exit_json(**timings.report(result))
+
+    # bulk mode: fetch all domains at once instead of looking up each one
+    try:
+        with timings.phase('lookup'):
+            domains = dict((d.name(), d) for d in conn.listAllDomains(0))
+    except libvirt.libvirtError as e:
+        module.fail_json(msg=str(e), debug=e.get_error_code())
+
+    # domains on peers are indexed at once if needed
+    index = None
+    if module.params['peers'] and any(
+            spec['name'] not in domains and spec['state'] not in
+            all_states_neg for spec in specs):
+        try:
+            with timings.phase('peers'):
+                index = peer_index(module.params)
+        except libvirt.libvirtError as e:
+            module.fail_json(msg=str(e), debug=e.get_error_code())
+
+    result['results'] = []
+    failed = False
+    for spec in specs:
+        try:
+            migrated = {}
+            domain_handle = domains.get(spec['name'])
+            if index and not domain_handle and \
+                    spec['state'] not in all_states_neg:
+                with timings.phase('peers'):
+                    domain_handle, migrated = resolve_duplicate(
+                        spec['name'], spec, module.params['uri'], index,
+                        module.check_mode)
+            res = {}
+            if not (module.check_mode and migrated):
+                res = converge(conn, domain_handle, spec, module.check_mode,
+                               module._diff, timings)
+            res.update(migrated)
+        except DomainError as e:
+            res = dict(changed=False, failed=True, msg=e.msg, **e.kwargs)
+        except libvirt.libvirtError as e:
+            res = dict(changed=False, failed=True, msg=str(e),
+                       debug=e.get_error_code())
+        res['name'] = spec['name']
+        failed = failed or res.get('failed', False)
+        result['changed'] = result['changed'] or res['changed']
+        result['results'].append(res)
+
+    timings.report(result)
+    if failed:
+        module.fail_json(msg="converging some domains failed.", **result)
     module.exit_json(**result)
 
 
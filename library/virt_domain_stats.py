@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+import csv
+import io
+import numbers
+import time
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.virt_common import libvirt
+from ansible.module_utils.virt_common.connection import virt_connect
+from ansible.module_utils.virt_common.state import monotonic
+from ansible.module_utils.virt_common.timing import module_timings
+
+# groups of this module in order of their columns
+stats_order = ['cpu', 'vcpu', 'block', 'interface', 'balloon']
+
+# libvirt stats groups by group name of this module
+stats_groups = {
+    'cpu': 'VIR_DOMAIN_STATS_CPU_TOTAL',
+    'vcpu': 'VIR_DOMAIN_STATS_VCPU',
+    'block': 'VIR_DOMAIN_STATS_BLOCK',
+    'interface': 'VIR_DOMAIN_STATS_INTERFACE',
+    'balloon': 'VIR_DOMAIN_STATS_BALLOON',
+}
+
+# metrics by group: (name, key, kind, scale). statistics of devices and vcpus
+# are summed up, their index is replaced by '*' in key. 'rate' metrics are
+# the difference of both samples per second, 'gauge' metrics are taken from
+# the second sample. times are given in ns, so scale 1e-7 gives percent of
+# one cpu.
+stats_metrics = {
+    'cpu': [('cpu_percent', 'cpu.time', 'rate', 1e-7)],
+    'vcpu': [('vcpus', 'vcpu.current', 'gauge', 1),
+             ('vcpu_percent', 'vcpu.*.time', 'rate', 1e-7),
+             ('vcpu_wait_percent', 'vcpu.*.wait', 'rate', 1e-7),
+             ('vcpu_delay_percent', 'vcpu.*.delay', 'rate', 1e-7)],
+    'block': [('block_rd_bps', 'block.*.rd.bytes', 'rate', 1),
+              ('block_wr_bps', 'block.*.wr.bytes', 'rate', 1),
+              ('block_rd_iops', 'block.*.rd.reqs', 'rate', 1),
+              ('block_wr_iops', 'block.*.wr.reqs', 'rate', 1)],
+    'interface': [('net_rx_bps', 'net.*.rx.bytes', 'rate', 1),
+                  ('net_tx_bps', 'net.*.tx.bytes', 'rate', 1),
+                  ('net_rx_pps', 'net.*.rx.pkts', 'rate', 1),
+                  ('net_tx_pps', 'net.*.tx.pkts', 'rate', 1)],
+    'balloon': [('mem_current_kib', 'balloon.current', 'gauge', 1),
+                ('mem_rss_kib', 'balloon.rss', 'gauge', 1),
+                ('mem_usable_kib', 'balloon.usable', 'gauge', 1)],
+}
+
+
+def stats_sample(conn, groups, names):
+    """ returns dict of (name, summed statistics) by UUID of all running
+    domains (only those of names if given) fetched in a single call """
+    flags = 0
+    for g in groups:
+        flags |= getattr(libvirt, stats_groups[g])
+    sample = {}
+    for dom, stats in conn.getAllDomainStats(
+            flags, libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE):
+        name = dom.name()
+        if names and name not in names:
+            continue
+        summed = {}
+        for key, value in stats.items():
+            if not isinstance(value, numbers.Number) or \
+                    isinstance(value, bool):
+                continue
+            parts = key.split('.')
+            if len(parts) > 2 and parts[1].isdigit():
+                parts[1] = '*'
+                key = '.'.join(parts)
+            summed[key] = summed.get(key, 0) + value
+        sample[dom.UUIDString()] = (name, summed)
+    return sample
+
+
+def stats_rates(first, second, elapsed, metrics):
+    """ returns list of rows (name followed by values of metrics) of domains
+    present in both samples. values missing in a sample are None. """
+    rows = []
+    for uuid, (name, stats) in sorted(second.items(),
+                                      key=lambda i: i[1][0]):
+        if uuid not in first:  # started while sampling
+            continue
+        before = first[uuid][1]
+        row = [name]
+        for _, key, kind, scale in metrics:
+            value = stats.get(key)
+            if value is not None and kind == 'rate':
+                value = (value - before[key]) / elapsed \
+                    if key in before else None
+            row.append(round(value * scale, 2) if value is not None
+                       else None)
+        rows.append(row)
+    return rows
+
+
+def line_escape(value):
+    """ escapes tag values of line protocol """
+    return value.replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+
+def format_line(columns, rows, measurement, uri, timestamp):
+    """ returns rows as influx line protocol """
+    lines = []
+    for row in rows:
+        fields = ",".join("%s=%s" % (c, v)
+                          for c, v in zip(columns[1:], row[1:])
+                          if v is not None)
+        if fields:
+            lines.append("%s,domain=%s,uri=%s %s %d" % (
+                line_escape(measurement), line_escape(row[0]),
+                line_escape(uri), fields, timestamp))
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def format_csv(columns, rows):
+    """ returns rows as csv including a header """
+    out = io.StringIO() if str is not bytes else io.BytesIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+def main():
+    module = AnsibleModule(argument_spec=dict(
+        uri=dict(default='qemu:///system'),
+        broker=dict(type='bool', default=True),  # use connection broker
+        names=dict(type='list', default=[]),  # domains to sample, all if []
+        groups=dict(type='list', default=stats_order),
+        interval=dict(type='float', default=5),  # seconds between samples
+        # 'table' returns columns and rows, 'line' (influx line protocol)
+        # and 'csv' return 'output' or write it to dest.
+        format=dict(choices=['table', 'line', 'csv'], default='table'),
+        dest=dict(),
+        measurement=dict(default='virt_domain'),  # name used in line format
+        # return durations of phases as 'timings', write cProfile statistics
+        timings=dict(type='bool', default=False),
+        profile_out_path=dict(),
+    ), supports_check_mode=True)
+    result = dict(changed=False)
+    timings = module_timings(module)
+
+    unknown = set(module.params['groups']) - set(stats_groups)
+    if unknown:
+        module.fail_json(msg="unsupported groups: %s" %
+                         ", ".join(sorted(unknown)))
+    groups = [g for g in stats_order if g in module.params['groups']]
+    metrics = [m for g in groups for m in stats_metrics[g]]
+    names = set(module.params['names'])
+
+    with timings.phase('open'):
+        conn = virt_connect(module, readonly=True)
+
+    try:
+        with timings.phase('sample'):
+            start = monotonic()
+            first = stats_sample(conn, groups, names)
+        time.sleep(max(module.params['interval'], 0))
+        with timings.phase('sample'):
+            elapsed = monotonic() - start
+            second = stats_sample(conn, groups, names)
+    except libvirt.libvirtError as e:
+        module.fail_json(msg=str(e), debug=e.get_error_code())
+
+    columns = ['name'] + [m[0] for m in metrics]
+    rows = stats_rates(first, second, elapsed, metrics)
+    result['interval'] = round(elapsed, 3)
+    if module.params['format'] == 'table':
+        result['columns'] = columns
+        result['rows'] = rows
+        module.exit_json(**timings.report(result))
+
+    if module.params['format'] == 'line':
+        output = format_line(columns, rows, module.params['measurement'],
+                             module.params['uri'], int(time.time() * 1e9))
+    else:
+        output = format_csv(columns, rows)
+    if module.params['dest']:
+        dest = module.params['dest']
+        try:
+            with open(dest) as f:
+                result['changed'] = f.read() != output
+        except (IOError, OSError):
+            result['changed'] = True  # missing or unreadable
+        if result['changed'] and not module.check_mode:
+            try:
+                with open(dest, 'w') as f:
+                    f.write(output)
+            except (IOError, OSError) as e:
+                module.fail_json(msg="writing %s failed: %s" % (dest, e))
+        result['dest'] = dest
+    else:
+        result['output'] = output
+    module.exit_json(**timings.report(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,91 +1,155 @@
 #!/usr/bin/env python
 
-try:
-    import libvirt
-except ImportError:
-    installed_libvirt_py = False
-else:
-    installed_libvirt_py = True
-
-import datetime
-import time
+import collections
 
 from ansible.module_utils.basic import AnsibleModule
-
-def eh_dummy(x, y):
-    """ dummy error handler to supress error messages to stderr """
-    pass
-
-
-def dom_state(domain):
-    ''' receives state of domain by domain handle. If a falsey domain handle
-        is given (e.g. None) state 'unknown' is emitted.
-        returns: Tuple of (state, strange), where state is the domains state
-            and strange is True if libvirt returns a state like 'blocked' or
-            'pmsuspended'. However, those states should never appear. '''
-
-    # notice that there is no "undefined" state returned here since that
-    # causes the domain to be nonexistent.
-    states = {
-        libvirt.VIR_DOMAIN_NOSTATE:     ('running', True),
-        libvirt.VIR_DOMAIN_BLOCKED:     ('running', True),
-        libvirt.VIR_DOMAIN_RUNNING:     ('running', False),
-        libvirt.VIR_DOMAIN_PAUSED:      ('running', False), # FIXME
-        libvirt.VIR_DOMAIN_SHUTDOWN:    ('present', False),
-        libvirt.VIR_DOMAIN_SHUTOFF:     ('present', False),
-        libvirt.VIR_DOMAIN_CRASHED:     ('unknown', True),
-        libvirt.VIR_DOMAIN_PMSUSPENDED: ('unknown', True),
-    }
-
-    if not domain:
-        return 'absent', False
-
-    dom_state, _ = domain.state()  # get domain state from libvirt
-    return states.get(dom_state, ('unknown', True))
-
-
-all_states=['present','running','absent']
+from ansible.module_utils.virt_common import libvirt
+from ansible.module_utils.virt_common.connection import virt_connect, lookup
+from ansible.module_utils.virt_common.state import dom_state, \
+    event_loop_start, monotonic, wait_for, agents_ready
+from ansible.module_utils.virt_common.timing import module_timings
+
+
+# booted: running and the guest agent answers
+all_states=['present','running','booted','saved','absent']
+
+# states of this module by states of dom_state
+wait_states = {
+    'undefined': 'absent',
+    'defined': 'present',
+    'running': 'running',
+    'paused': 'running',  # FIXME
+    'saved': 'saved',
+    'unknown': 'unknown',
+}
+
+# states satisfying other desired states than their own
+wait_satisfies = {
+    'saved': ['present'],  # a managed saved domain is defined
+}
 
 def main():
     module = AnsibleModule(argument_spec=dict(
-        name=dict(aliases=['guest'],required=True),
+        name=dict(aliases=['guest']),
         state=dict(choices=all_states, default='running'),
+        # wait for many domains at once: list of names or dicts of name and
+        # state. all domains share the connection and the timeout.
+        domains=dict(type='list'),
         uri=dict(default='qemu:///system'),
+        broker=dict(type='bool', default=True),  # use connection broker
         sleep=dict(type='int', default=10),
         timeout=dict(type='int', default=60*60),
-    ), supports_check_mode=True)
+        # return durations of phases as 'timings', write cProfile statistics
+        timings=dict(type='bool', default=False),
+        profile_out_path=dict(),
+    ), supports_check_mode=True, mutually_exclusive=[['name', 'domains']],
+        required_one_of=[['name', 'domains']])
     result = dict(changed=False, message='')
-
-    if not installed_libvirt_py:
-        module.fail_json(msg="'libvirt' python library is missing on host.")
-    libvirt.registerErrorHandler(eh_dummy, 'ctx')  # apply dummy error handler
-
-    # connect to libvirt host
-    conn = libvirt.openReadOnly(module.params['uri'])
-    if not conn:
-        module.fail_json(msg="connection to libvirt failed.")
-
-    # find domain
-    domain_handle = None
-    try:
-        domain_handle = conn.lookupByName(module.params['name'])
-    except libvirt.libvirtError as e:
-        if(e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN):
+    timings = module_timings(module)
+
+    # desired state by domain name
+    targets = collections.OrderedDict()
+    for item in module.params['domains'] or [module.params['name']]:
+        if not isinstance(item, dict):
+            item = dict(name=item)
+        if not item.get('name'):
+            module.fail_json(msg="each item of domains needs a name.")
+        targets[item['name']] = item.get('state', module.params['state'])
+        if targets[item['name']] not in all_states:
+            module.fail_json(msg="invalid state for domain %s." %
+                             item['name'])
+
+    # event loop has to be registered before connecting. guest agent
+    # commands need a connection which is not read-only.
+    agent = 'booted' in targets.values()
+    with timings.phase('open'):
+        conn = virt_connect(module, readonly=not agent,
+                            before_open=event_loop_start)
+
+    handles = {}  # domain handles by name
+    states = {}  # last seen state by name
+    arrived = {}  # seconds until reaching the desired state by name
+    osinfo = {}  # operating system reported by the guest agent by name
+    start = monotonic()
+
+    def find(names):
+        """ looks up domains. many domains are fetched at once. domains not
+        found now may be defined while waiting. """
+        try:
+            with timings.phase('lookup'):
+                if len(names) == 1:
+                    handles[names[0]] = lookup(conn.lookupByName, names[0],
+                                               libvirt.VIR_ERR_NO_DOMAIN)
+                else:
+                    handles.update((d.name(), d)
+                                   for d in conn.listAllDomains(0)
+                                   if d.name() in targets)
+        except libvirt.libvirtError as e:
             module.fail_json(msg=str(e), debug=e.get_error_code())
 
-    end = datetime.datetime.utcnow() + datetime.timedelta(
-            seconds=module.params['timeout'])
-
-    while datetime.datetime.utcnow() < end:
-        # evaluate domain state ... first get current state
-        current_state, strange_state = dom_state(domain_handle) # FIXME
-        if current_state == module.params['state']:
-            result['message']="state reached"
-            break
-        elif current_state == 'unknown':
-            module.fail_json(msg="invalid state")
-            break
-        time.sleep(module.params['sleep'])
+    def reached():
+        pending = [n for n in targets if n not in arrived]
+        missing = [n for n in pending if not handles.get(n)]
+        if missing:
+            find(missing)
+        booting = []  # running domains whose agents are to be pinged
+        for name in pending:
+            try:
+                current_state, strange_state = dom_state(handles.get(name))
+            except libvirt.libvirtError as e:
+                if(e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN):
+                    module.fail_json(msg=str(e), debug=e.get_error_code())
+                handles[name] = None
+                current_state = 'undefined'
+            states[name] = wait_states[current_state]
+            if states[name] == 'unknown':
+                module.fail_json(msg="invalid state", name=name)
+            if states[name] == 'running' and targets[name] == 'booted' \
+                    and current_state == 'running':
+                booting.append(name)
+            elif states[name] == targets[name] or \
+                    targets[name] in wait_satisfies.get(states[name], ()):
+                arrived[name] = round(monotonic() - start, 3)
+        if booting:
+            with timings.phase('agent'):
+                ready = agents_ready([handles[n] for n in booting],
+                                     'guest-get-osinfo')
+            for domain, info in ready:
+                name = domain.name()
+                states[name] = 'booted'
+                osinfo[name] = info
+                arrived[name] = round(monotonic() - start, 3)
+        return len(arrived) == len(targets)
+
+    find(list(targets))
+
+    # events of any domain are watched if waiting for more than one. the
+    # guest agent may not announce itself, so it is polled with backoff.
+    events = ['VIR_DOMAIN_EVENT_ID_LIFECYCLE']
+    if agent:
+        events.append('VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE')
+    with timings.phase('wait'):
+        reached_state = wait_for(
+            conn, handles.get(module.params['name']), reached,
+            module.params['timeout'], module.params['sleep'],
+            events=events, backoff=agent)
+
+    if module.params['name']:
+        result['state'] = states[module.params['name']]
+        if module.params['name'] in osinfo:
+            result['osinfo'] = osinfo[module.params['name']]
+    else:
+        result['results'] = [dict(name=name, state=states.get(name),
+                                  reached=name in arrived,
+                                  elapsed=arrived.get(name))
+                             for name in targets]
+        for res in result['results']:
+            if res['name'] in osinfo:
+                res['osinfo'] = osinfo[res['name']]
+    timings.report(result)
+    if not reached_state:
+        module.fail_json(msg="timeout waiting for domain state.", **result)
+    result['message'] = "state reached"
 
     module.exit_json(**result)
         
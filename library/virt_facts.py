@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.virt_common import libvirt
+from ansible.module_utils.virt_common.connection import virt_connect
+from ansible.module_utils.virt_common.facts import facts_collect
+from ansible.module_utils.virt_common.timing import module_timings
+
+
+def main():
+    module = AnsibleModule(argument_spec=dict(
+        uri=dict(default='qemu:///system'),
+        broker=dict(type='bool', default=True),  # use connection broker
+        xml=dict(type='bool', default=True),  # summarize definitions
+        # facts are cached on the host running the module. cache_ttl 0 or
+        # refresh always fetches them, invalidate drops cached summaries of
+        # the given domain UUIDs.
+        cache_dir=dict(default='~/.cache/virt_facts'),
+        cache_ttl=dict(type='int', default=300),
+        refresh=dict(type='bool', default=False),
+        invalidate=dict(type='list', default=[]),
+        # return durations of phases as 'timings', write cProfile statistics
+        timings=dict(type='bool', default=False),
+        profile_out_path=dict(),
+    ), supports_check_mode=True)
+    result = dict(changed=False)
+    timings = module_timings(module)
+
+    def connect():
+        with timings.phase('open'):
+            return virt_connect(module, readonly=True)
+
+    try:
+        with timings.phase('collect'):
+            domains, cached = facts_collect(
+                module.params['uri'], connect, module.params['cache_dir'],
+                0 if module.params['refresh'] else module.params['cache_ttl'],
+                module.params['xml'], module.params['invalidate'])
+    except libvirt.libvirtError as e:
+        module.fail_json(msg=str(e), debug=e.get_error_code())
+    except (IOError, OSError) as e:
+        module.fail_json(msg="writing facts cache failed: %s" % e)
+
+    result['cached'] = cached
+    result['ansible_facts'] = dict(virt_domains=domains)
+    module.exit_json(**timings.report(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,10 @@
 
 # NOTICE: this module is very basic and missing a lot of features
 
-try:
-    import libvirt
-except ImportError:
-    installed_libvirt_py = False
-else:
-    installed_libvirt_py = True
-
-import re
-
 from ansible.module_utils.basic import AnsibleModule
-
-def eh_dummy(x, y):
-    """ dummy error handler to supress error messages to stderr """
-    pass
+from ansible.module_utils.virt_common import libvirt
+from ansible.module_utils.virt_common.connection import virt_connect, lookup
+from ansible.module_utils.virt_common.timing import module_timings
 
 all_states=['present','absent']
 
@@ -38,30 +28,29 @@ def main():
         name=dict(aliases=['net'],required=True),
         state=dict(choices=all_states, default='present'),
         uri=dict(default='qemu:///system'),
+        broker=dict(type='bool', default=True),  # use connection broker
         autostart=dict(type='bool',default=True), # FIXME: change is not implemented yet
         xml=dict(),
+        # return durations of phases as 'timings', write cProfile statistics
+        timings=dict(type='bool', default=False),
+        profile_out_path=dict(),
         ),
     supports_check_mode=True)
     result = dict(changed=False, message='')
-
-    if not installed_libvirt_py:
-        module.fail_json(msg="'libvirt' python library is missing on host.")
-    libvirt.registerErrorHandler(eh_dummy, 'ctx')  # apply dummy error handler
+    timings = module_timings(module)
 
     # connect to libvirt host
-    conn = libvirt.open(module.params['uri']) if not module.check_mode else \
-        libvirt.openReadOnly(module.params['uri'])
-    if not conn:
-        module.fail_json(msg="connection to libvirt failed.")
-
-    net_handle = None
+    with timings.phase('open'):
+        conn = virt_connect(module, readonly=module.check_mode)
 
     # look for network
     try:
-        net_handle = conn.networkLookupByName(module.params['name'])
+        with timings.phase('lookup'):
+            net_handle = lookup(conn.networkLookupByName,
+                                module.params['name'],
+                                libvirt.VIR_ERR_NO_NETWORK)
     except libvirt.libvirtError as e:
-        if e.get_error_code() != libvirt.VIR_ERR_NO_NETWORK:
-            module.fail_json(msg=str(e), debug=(e.get_error_code(), str(e)))
+        module.fail_json(msg=str(e), debug=(e.get_error_code(), str(e)))
 
     # apply state
     if not net_handle and module.params['state']=='present':
@@ -71,19 +60,22 @@ def main():
             module.fail_json(msg="you should define a xml")
 
         if not module.check_mode:
-            define_net(conn,module.params['name'],module.params['xml'],
-                   module.params['autostart'])
+            with timings.phase('define'):
+                define_net(conn,module.params['name'],module.params['xml'],
+                       module.params['autostart'])
     elif net_handle and module.params['state']=='absent':
         result['changed']=True
         if not module.check_mode:
-            undefine_net(net_handle)
+            with timings.phase('undefine'):
+                undefine_net(net_handle)
     elif module.params['state']=='leases':
         if not net_handle:
             module.fail_json(msg="net does not exist")
         result['changed']=False
-        result['leases']=net_handle.DHCPLeases()
+        with timings.phase('leases'):
+            result['leases']=net_handle.DHCPLeases()
 
-    module.exit_json(**result)
+    module.exit_json(**timings.report(result))
         
 if __name__ == '__main__':
     main()
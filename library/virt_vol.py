@@ -2,20 +2,15 @@
 
 # NOTICE: this module is very basic and missing a lot of features
 
-try:
-    import libvirt
-except ImportError:
-    installed_libvirt_py = False
-else:
-    installed_libvirt_py = True
-
+import errno
+import os
 import re
 
 from ansible.module_utils.basic import AnsibleModule
-
-def eh_dummy(x, y):
-    """ dummy error handler to supress error messages to stderr """
-    pass
+from ansible.module_utils.virt_common import libvirt, ET
+from ansible.module_utils.virt_common.connection import virt_connect, lookup
+from ansible.module_utils.virt_common.state import monotonic
+from ansible.module_utils.virt_common.timing import module_timings
 
 all_states=['present','absent']
 
@@ -31,7 +26,7 @@ def get_capacity(capdef):
     
 
 def define_vol(pool,name,capacity,thin=True):
-    pool.createXML("<volume type='block'> <name>%s</name> "%name +
+    return pool.createXML("<volume type='block'> <name>%s</name> "%name +
         "<capacity unit='%s'>%s</capacity>"%(capacity['unit'],
             capacity['value']) +
         ("<allocation>0</allocation>" if thin else "") + "</volume>")
@@ -39,64 +34,270 @@ def define_vol(pool,name,capacity,thin=True):
 def undefine_vol(disk):
     disk.delete()
 
+
+# storage pool types whose volumes are files which may be qcow2 overlays
+file_pools = ['dir', 'fs', 'netfs']
+
+
+def clone_base(pool, base):
+    """ returns dict describing volume base of pool for clone_vol, fetched
+    once for all clones """
+    base_format = ET.fromstring(base.XMLDesc(0)).find('target/format')
+    return dict(vol=base, path=base.path(), capacity=base.info()[1],
+                format=base_format.get('type')
+                if base_format is not None else None,
+                file_pool=ET.fromstring(pool.XMLDesc(0)).get('type')
+                in file_pools)
+
+
+def clone_vol(pool, name, base, capacity=None, method='overlay'):
+    """ creates volume name as clone of the volume described by base (see
+    clone_base) and returns it. 'overlay' creates a copy-on-write volume
+    backed by base (a qcow2 overlay in file pools, a snapshot in LVM pools),
+    'reflink' and 'copy' let libvirt copy base sharing its blocks or not.
+    capacity (as returned by get_capacity) defaults to the one of base. """
+    root = ET.Element('volume')
+    ET.SubElement(root, 'name').text = name
+    if capacity:
+        ET.SubElement(root, 'capacity', unit=capacity['unit']).text = \
+            capacity['value']
+    else:
+        ET.SubElement(root, 'capacity', unit='bytes').text = \
+            str(base['capacity'])
+
+    if method != 'overlay':
+        if base['format']:
+            target = ET.SubElement(root, 'target')
+            ET.SubElement(target, 'format', type=base['format'])
+        flags = 0
+        if method == 'reflink':
+            flags = libvirt.VIR_STORAGE_VOL_CREATE_REFLINK
+        return pool.createXMLFrom(ET.tostring(root).decode('utf-8'),
+                                  base['vol'], flags)
+
+    if base['file_pool']:
+        target = ET.SubElement(root, 'target')
+        ET.SubElement(target, 'format', type='qcow2')
+    backing = ET.SubElement(root, 'backingStore')
+    ET.SubElement(backing, 'path').text = base['path']
+    if base['format']:
+        ET.SubElement(backing, 'format', type=base['format'])
+    return pool.createXML(ET.tostring(root).decode('utf-8'), 0)
+
+
+def file_section(fd):
+    """ returns tuple of whether the current offset of file fd is inside
+    data (not a hole) and the length of that section """
+    cur = os.lseek(fd, 0, os.SEEK_CUR)
+    try:
+        data = os.lseek(fd, cur, os.SEEK_DATA)
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            raise
+        data = -1  # trailing hole
+    if data == cur:
+        section = (True, os.lseek(fd, data, os.SEEK_HOLE) - data)
+    elif data > cur:
+        section = (False, data - cur)
+    else:
+        section = (False, os.lseek(fd, 0, os.SEEK_END) - cur)
+    os.lseek(fd, cur, os.SEEK_SET)
+    return section
+
+
+def upload_vol(conn, vol, path, sparse=True):
+    """ streams the content of file path into volume vol. holes of the file
+    are skipped if sparse is set and supported by libvirt. returns dict of
+    'size', 'sent' and 'skipped' bytes, 'seconds' and 'bytes_per_second'
+    sent. """
+    sparse = sparse and \
+        hasattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM')
+    stats = dict(sent=0, skipped=0)
+
+    def read(stream, nbytes, fd):
+        data = os.read(fd, nbytes)
+        stats['sent'] += len(data)
+        return data
+
+    def hole(stream, fd):
+        return list(file_section(fd))
+
+    def skip(stream, length, fd):
+        os.lseek(fd, length, os.SEEK_CUR)
+        stats['skipped'] += length
+        return 0
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        start = monotonic()
+        stream = conn.newStream(0)
+        vol.upload(stream, 0, size,
+                   libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM if sparse
+                   else 0)
+        try:
+            if sparse:
+                stream.sparseSendAll(read, hole, skip, fd)
+            else:
+                stream.sendAll(read, fd)
+            stream.finish()
+        except Exception:
+            stream.abort()
+            raise
+        seconds = monotonic() - start
+    finally:
+        os.close(fd)
+    return dict(size=size, sent=stats['sent'], skipped=stats['skipped'],
+                seconds=round(seconds, 3),
+                bytes_per_second=int(stats['sent'] / seconds)
+                if seconds else None)
+
 all_states=['present','absent']
 
+def converge_vol(module, conn, pool_handle, name, disk_handle, base,
+                 timings):
+    """ brings volume name (disk_handle, None if missing) of pool_handle into
+    the state given by module parameters, cloning it from base (see
+    clone_base) if given. returns result dict, raises
+    ValueError, OSError or libvirtError on failure. """
+    result = dict(changed=False)
+    if not disk_handle and module.params['state'] == 'present':
+        result['changed'] = True
+
+        # determine capacity first, clones default to the one of their base
+        source_size = None
+        if module.params['source']:
+            try:
+                source_size = os.path.getsize(module.params['source'])
+            except OSError as e:
+                raise ValueError("can not read source: %s" % e)
+        capacity = None
+        if module.params['capacity']:
+            capacity = get_capacity(module.params['capacity'])
+            if not capacity:
+                raise ValueError("invalid capacity format")
+        elif source_size is not None:
+            capacity = {'value': str(source_size), 'unit': 'bytes'}
+        elif not base:
+            raise ValueError("you should define a capacity")
+
+        if module.check_mode:
+            return result
+        try:
+            if base:
+                with timings.phase('clone'):
+                    disk_handle = clone_vol(pool_handle, name, base,
+                                            capacity, module.params['clone'])
+            else:
+                with timings.phase('create'):
+                    disk_handle = define_vol(
+                        pool_handle, name, capacity,
+                        thin=(module.params['allocation'] == 'thin'))
+            if module.params['source']:
+                with timings.phase('upload'):
+                    result['upload'] = upload_vol(
+                        conn, disk_handle, module.params['source'],
+                        module.params['sparse'])
+        except (libvirt.libvirtError, OSError):
+            if disk_handle:  # do not leave a partial copy behind
+                undefine_vol(disk_handle)
+            raise
+    elif disk_handle and module.params['state'] == 'absent':
+        result['changed'] = True
+        if not module.check_mode:
+            with timings.phase('delete'):
+                undefine_vol(disk_handle)
+    return result
+
+
 def main():
     module = AnsibleModule(argument_spec=dict(
         pool=dict(required=True),
-        name=dict(aliases=['vol'],required=True),
+        name=dict(aliases=['vol']),
+        names=dict(type='list'),  # bulk mode: several volumes alike
         state=dict(choices=all_states, default='present'),
         uri=dict(default='qemu:///system'),
+        broker=dict(type='bool', default=True),  # use connection broker
         capacity=dict(aliases=['size']),
         allocation=dict(choices=['thin','fat'], default='thin'),
+        # image on the managed host streamed into the volume when creating
+        # it, skipping holes if 'sparse'. capacity defaults to its size.
+        source=dict(type='path'),
+        sparse=dict(type='bool', default=True),
+        # volume of the pool new volumes are cloned from: copy-on-write
+        # ('overlay') or copied by libvirt sharing blocks ('reflink') or not
+        base=dict(),
+        clone=dict(choices=['overlay', 'reflink', 'copy'],
+                   default='overlay'),
+        # return durations of phases as 'timings', write cProfile statistics
+        timings=dict(type='bool', default=False),
+        profile_out_path=dict(),
         ),
-    supports_check_mode=True)
+    supports_check_mode=True, mutually_exclusive=[['name', 'names'],
+                                                  ['source', 'base']],
+    required_one_of=[['name', 'names']])
     result = dict(changed=False, message='')
+    timings = module_timings(module)
 
-    if not installed_libvirt_py:
-        module.fail_json(msg="'libvirt' python library is missing on host.")
-    libvirt.registerErrorHandler(eh_dummy, 'ctx')  # apply dummy error handler
+    # streams can not pass the connection broker
+    if module.params['source']:
+        module.params['broker'] = False
 
     # connect to libvirt host
-    conn = libvirt.open(module.params['uri']) if not module.check_mode else \
-        libvirt.openReadOnly(module.params['uri'])
-    if not conn:
-        module.fail_json(msg="connection to libvirt failed.")
+    with timings.phase('open'):
+        conn = virt_connect(module, readonly=module.check_mode)
 
     pool_handle = None
-    disk_handle = None
+    base = None
+    names = module.params['names'] or [module.params['name']]
 
-    # look for volume
+    # look for volumes, all of them at once in bulk mode
     try:
-        pool_handle = conn.storagePoolLookupByName(module.params['pool'])
-        disk_handle = pool_handle.storageVolLookupByName(module.params['name'])
+        with timings.phase('lookup'):
+            pool_handle = conn.storagePoolLookupByName(module.params['pool'])
+            if module.params['names'] is not None:
+                vols = dict((v.name(), v)
+                            for v in pool_handle.listAllVolumes(0))
+            else:
+                vols = {names[0]: lookup(pool_handle.storageVolLookupByName,
+                                         names[0],
+                                         libvirt.VIR_ERR_NO_STORAGE_VOL)}
+            if module.params['base'] and module.params['state'] == 'present':
+                base = clone_base(pool_handle,
+                                  pool_handle.storageVolLookupByName(
+                                      module.params['base']))
     except libvirt.libvirtError as e:
         if e.get_error_code() == libvirt.VIR_ERR_NO_STORAGE_POOL:
             module.fail_json(msg="no such pool", debug=(e.get_error_code(),
                 str(e)))
-        elif e.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
-            module.fail_json(msg=str(e), debug=e.get_error_code())
+        module.fail_json(msg=str(e), debug=e.get_error_code())
 
-    # apply state
-    if not disk_handle and module.params['state']=='present':
-        result['changed']=True
+    if module.params['names'] is None:
+        try:
+            result.update(converge_vol(module, conn, pool_handle, names[0],
+                                       vols[names[0]], base, timings))
+        except (ValueError, libvirt.libvirtError, OSError) as e:
+            module.fail_json(msg=str(e), **timings.report({}))
+        module.exit_json(**timings.report(result))
 
-        # determine capacity first
-        if not 'capacity' in module.params:
-            module.fail_json(msg="you should define a capacity")
-        capacity=get_capacity(module.params['capacity'])
-        if not capacity:
-            module.fail_json(msg="invalid capacity format")
-
-        if not module.check_mode:
-            define_vol(pool_handle,module.params['name'],capacity,
-                    thin=(module.params['allocation']=='thin'))
-    elif disk_handle and module.params['state']=='absent':
-        result['changed']=True
-        if not module.check_mode:
-            undefine_vol(disk_handle)
+    result['results'] = []
+    failed = False
+    for name in names:
+        try:
+            res = converge_vol(module, conn, pool_handle, name,
+                               vols.get(name), base, timings)
+        except (ValueError, libvirt.libvirtError, OSError) as e:
+            res = dict(changed=False, failed=True, msg=str(e))
+        res['name'] = name
+        failed = failed or res.get('failed', False)
+        result['changed'] = result['changed'] or res['changed']
+        result['results'].append(res)
 
+    timings.report(result)
+    if failed:
+        module.fail_json(msg="converging some volumes failed.", **result)
     module.exit_json(**result)
-        
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,96 @@
+""" hypervisor a domain is defined on
+
+Uses the helpers of module_utils/virt_common, which are made importable as
+ansible.module_utils.virt_common from the directory next to this one.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    lookup: virt_domain_location
+    short_description: hypervisor a domain is defined on
+    description:
+        - Returns the name of the hypervisor each domain (given by name or
+          UUID) is defined on or an empty string if it is not defined.
+        - All hypervisors are queried in parallel using one bulk call each.
+          The index is cached on disk (see module virt_facts).
+        - Fails if a domain is defined on more than one hypervisor.
+    options:
+        _terms:
+            description: names or UUIDs of domains
+            required: True
+        hypervisors:
+            description: dict of libvirt URIs by hypervisor name or list of
+                URIs, which are returned as names then
+            required: True
+        broker:
+            description: connect through the connection broker if running
+            type: bool
+            default: True
+        cache_dir:
+            description: directory of the cache
+            default: ~/.cache/virt_facts
+        cache_ttl:
+            description: seconds the cached index is used, 0 disables it
+            type: int
+            default: 60
+        workers:
+            description: number of hypervisors queried at once
+            type: int
+            default: 8
+'''
+
+EXAMPLES = '''
+- set_fact:
+    hypervisor: "{{ lookup('virt_domain_location', inventory_hostname,
+                           hypervisors=hypervisor_uris) |
+                    default(groups['hypervisor'] | random, true) }}"
+'''
+
+import os
+
+import ansible.module_utils
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+
+MODULE_UTILS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'module_utils')
+if MODULE_UTILS not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.append(MODULE_UTILS)
+
+from ansible.module_utils.virt_common import libvirt, libvirt_available
+from ansible.module_utils.virt_common.connection import virt_open
+from ansible.module_utils.virt_common.location import location_index
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        self.set_options(var_options=variables, direct=kwargs)
+        if not libvirt_available():
+            raise AnsibleError("'libvirt' python library is missing.")
+        hypervisors = self.get_option('hypervisors')
+        if not isinstance(hypervisors, dict):
+            hypervisors = dict((uri, uri) for uri in hypervisors)
+
+        def connect(uri):
+            return virt_open(uri, readonly=True,
+                             broker=self.get_option('broker'))
+        try:
+            index = location_index(hypervisors, connect,
+                                   self.get_option('cache_dir'),
+                                   self.get_option('cache_ttl'),
+                                   self.get_option('workers'))
+        except libvirt.libvirtError as e:
+            raise AnsibleError("indexing domains failed: %s" % e)
+
+        ret = []
+        for term in terms:
+            owners = sorted(set(hv for hv, _ in index.get(term, [])))
+            if len(owners) > 1:
+                raise AnsibleError("domain %s is defined on %s." %
+                                   (term, ", ".join(owners)))
+            ret.append(owners[0] if owners else "")
+        return ret
@@ -0,0 +1,121 @@
+""" hypervisors for domains chosen by free resources
+
+Uses the helpers of module_utils/virt_common, which are made importable as
+ansible.module_utils.virt_common from the directory next to this one.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    lookup: virt_placement
+    short_description: hypervisors for domains chosen by free resources
+    description:
+        - Returns a dict of hypervisor names by domain name for all domains
+          given at once.
+        - All hypervisors are queried in parallel for cpus, free memory by
+          NUMA cell, free huge pages and vcpus of running domains.
+        - Domains already defined stay on their hypervisor, others are placed
+          largest first (bin packing). Fails if a domain does not fit
+          anywhere or is defined on more than one hypervisor.
+    options:
+        _terms:
+            description:
+                - domains (or lists of them) as dicts of C(name), C(memory),
+                  C(memory_unit) (default KiB), C(vcpus) (default 1) and
+                  C(hugepages) (page size in KiB or True for the smallest
+                  one available)
+            required: True
+        hypervisors:
+            description: dict of libvirt URIs by hypervisor name or list of
+                URIs, which are returned as names then
+            required: True
+        broker:
+            description: connect through the connection broker if running
+            type: bool
+            default: True
+        strategy:
+            description: C(pack) fills hypervisors up (best fit), C(spread)
+                takes the one with the most free memory
+            choices: ['pack', 'spread']
+            default: pack
+        cpu_ratio:
+            description: vcpus allowed per host cpu
+            type: float
+            default: 4.0
+        memory_reserve:
+            description: memory in KiB kept free on each hypervisor
+            type: int
+            default: 1048576
+        workers:
+            description: number of hypervisors queried at once
+            type: int
+            default: 8
+'''
+
+EXAMPLES = '''
+- set_fact:
+    placement: "{{ lookup('virt_placement', vm_specs,
+                          hypervisors=hypervisor_uris) }}"
+  run_once: True
+- set_fact:
+    hypervisor: "{{ placement[inventory_hostname] }}"
+'''
+
+import os
+
+import ansible.module_utils
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+
+MODULE_UTILS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'module_utils')
+if MODULE_UTILS not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.append(MODULE_UTILS)
+
+from ansible.module_utils.virt_common import libvirt, libvirt_available
+from ansible.module_utils.virt_common.connection import virt_open
+from ansible.module_utils.virt_common.location import hypervisors_query
+from ansible.module_utils.virt_common.placement import host_resources, \
+    spec_normalize, placement_plan
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        self.set_options(var_options=variables, direct=kwargs)
+        if not libvirt_available():
+            raise AnsibleError("'libvirt' python library is missing.")
+        hypervisors = self.get_option('hypervisors')
+        if not isinstance(hypervisors, dict):
+            hypervisors = dict((uri, uri) for uri in hypervisors)
+
+        specs = []
+        try:
+            for term in terms:
+                for spec in term if isinstance(term, list) else [term]:
+                    specs.append(spec_normalize(spec))
+        except (KeyError, TypeError, ValueError) as e:
+            raise AnsibleError("invalid domain spec: %s" % e)
+
+        def query(uri):
+            return host_resources(virt_open(
+                uri, readonly=True, broker=self.get_option('broker')))
+        try:
+            hosts = dict(hypervisors_query(hypervisors, query,
+                                           self.get_option('workers')))
+        except libvirt.libvirtError as e:
+            raise AnsibleError("querying hypervisors failed: %s" % e)
+
+        try:
+            plan, unplaced = placement_plan(
+                hosts, specs, self.get_option('strategy'),
+                self.get_option('cpu_ratio'),
+                self.get_option('memory_reserve'))
+        except ValueError as e:
+            raise AnsibleError(str(e))
+        if unplaced:
+            raise AnsibleError("no hypervisor has resources left for %s." %
+                               ", ".join(sorted(unplaced)))
+        return [plan]
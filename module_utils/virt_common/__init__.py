@@ -0,0 +1,35 @@
+""" code shared by the virt_* modules.
+
+Heavy dependencies are imported lazily on first use, so paths of a module
+which do not need them don't pay for importing them. Import them from here:
+
+    from ansible.module_utils.virt_common import libvirt, ET
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """ proxy of module 'name' which is imported on first attribute access """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+libvirt = LazyModule('libvirt')
+libvirt_qemu = LazyModule('libvirt_qemu')  # guest agent commands
+ET = LazyModule('xml.etree.ElementTree')
+
+
+def libvirt_available():
+    """ returns True if the libvirt python library is installed """
+    try:
+        libvirt.virGetVersion
+    except ImportError:
+        return False
+    return True
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+""" libvirt connection broker
+
+Opening a libvirt connection (especially using qemu+ssh:// or TLS URIs) may
+take longer than the work a module does using it. The broker is a small per
+user daemon keeping connections open between module runs. Start it on the
+host running the modules as the same user:
+
+    python broker.py [--socket PATH] [--daemon]
+
+Modules use connection.virt_open() which connects through the broker if its
+socket is present and falls back to a direct connection otherwise. The
+socket and its directory must belong to the user and the directory must not
+be accessible by anyone else, otherwise the broker is not used (see
+broker_path_trusted).
+
+The broker speaks newline delimited JSON over a unix socket. Each request is
+either opening a connection ('open') or calling a method of an object known
+to the session ('call'). Objects are released at the end of a session.
+libvirt objects are passed by reference and proxied by BrokerObject on the
+client side. Callbacks (events, streams) can not be passed and raise
+VIR_ERR_NO_SUPPORT.
+"""
+
+import errno
+import functools
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import threading
+
+try:
+    from ansible.module_utils.virt_common import libvirt
+except ImportError:  # running as daemon without ansible
+    try:
+        import libvirt
+    except ImportError:
+        libvirt = None
+
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver
+
+KEEPALIVE_INTERVAL = 5  # seconds between keepalive messages
+KEEPALIVE_COUNT = 3  # unanswered keepalive messages until connection is dead
+
+# methods of libvirt objects which must not be called by clients since the
+# objects are shared between sessions
+BLOCKED_METHODS = ['close', 'unregisterCloseCallback']
+
+# functions of libvirt_qemu callable as methods of the object passed first
+QEMU_METHODS = ['qemuAgentCommand']
+
+
+class BrokerError(Exception):
+    """ raised if the broker can not be reached or broke the protocol """
+    pass
+
+
+def broker_socket_path():
+    """ returns path of the brokers socket. may be set using environment
+    variable VIRT_BROKER_SOCKET, defaults to the runtime directory of the user
+    (XDG_RUNTIME_DIR) or a directory of the user inside /tmp. """
+    if os.environ.get('VIRT_BROKER_SOCKET'):
+        return os.environ['VIRT_BROKER_SOCKET']
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'virt_broker.sock')
+    return os.path.join('/tmp', 'virt_broker-%d' % os.getuid(), 'broker.sock')
+
+
+def broker_path_trusted(path):
+    """ returns True if the directory of socket path and the socket (if
+    present) belong to the user and the directory has mode 0700. Others
+    could plant a socket of their own otherwise. """
+    path = os.path.abspath(path)
+    try:
+        d = os.lstat(os.path.dirname(path))
+    except OSError:
+        return False
+    if not stat.S_ISDIR(d.st_mode) or d.st_uid != os.getuid() or \
+            stat.S_IMODE(d.st_mode) != 0o700:
+        return False
+    try:
+        return os.lstat(path).st_uid == os.getuid()
+    except OSError as e:
+        return e.errno == errno.ENOENT  # broker not started yet
+
+
+def is_libvirt_object(value):
+    """ returns True if value is a libvirt object like virDomain which has to
+    be passed by reference """
+    cls = type(value)
+    return cls.__module__ == 'libvirt' and cls.__name__.startswith('vir')
+
+
+def libvirt_error(code, domain, msg):
+    """ returns libvirtError carrying error code and domain of the broker """
+    if libvirt is None:
+        return BrokerError(msg)
+    e = libvirt.libvirtError(msg)
+    e.err = (code, domain, msg, libvirt.VIR_ERR_ERROR,
+             None, None, None, 0, 0)
+    return e
+
+
+class BrokerObject(object):
+    """ proxy of a libvirt object living inside the broker. method calls are
+    forwarded to the broker. """
+    def __init__(self, client, ref, type_name):
+        self._client = client
+        self._ref = ref
+        self._type = type_name
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args):
+            return self._client.request(
+                op='call', obj=self._ref, method=name,
+                args=[self._client.encode(a) for a in args])
+        return call
+
+    def __repr__(self):
+        return "<%s proxy %d>" % (self._type, self._ref)
+
+
+class BrokerClient(object):
+    """ session with the broker. all objects of a session are released by the
+    broker when the session is closed. """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+        self.lock = threading.Lock()  # requests of several threads
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def request(self, **req):
+        """ sends request and returns decoded result or raises libvirtError
+        sent by the broker """
+        try:
+            with self.lock:
+                self.sock.sendall((json.dumps(req) + "\n").encode('utf-8'))
+                line = self.rfile.readline()
+        except socket.error as e:
+            raise BrokerError(str(e))
+        if not line:
+            raise BrokerError("broker closed connection")
+        resp = json.loads(line.decode('utf-8'))
+        if 'error' in resp:
+            raise libvirt_error(*resp['error'])
+        return self.decode(resp['ok'])
+
+    def encode(self, value):
+        if isinstance(value, BrokerObject):
+            return {'__ref__': value._ref}
+        elif isinstance(value, (list, tuple)):
+            return [self.encode(v) for v in value]
+        elif isinstance(value, dict):
+            return dict((k, self.encode(v)) for k, v in value.items())
+        elif callable(value):
+            raise libvirt_error(
+                libvirt.VIR_ERR_NO_SUPPORT, 0,
+                "callbacks are not supported by the connection broker")
+        return value
+
+    def decode(self, value):
+        if isinstance(value, list):
+            return [self.decode(v) for v in value]
+        elif isinstance(value, dict):
+            if '__ref__' in value:
+                return BrokerObject(self, value['__ref__'], value['__type__'])
+            return dict((k, self.decode(v)) for k, v in value.items())
+        return value
+
+    def open(self, uri, readonly=False):
+        return self.request(op='open', uri=uri, readonly=readonly)
+
+
+def broker_open(uri, readonly=False):
+    """ returns proxy of a connection to uri served by the broker or None if
+    the broker is not running. """
+    path = broker_socket_path()
+    if not os.path.exists(path) or not broker_path_trusted(path):
+        return None
+    try:
+        return BrokerClient(path).open(uri, readonly)
+    except (socket.error, OSError, BrokerError):
+        return None
+
+
+class Broker(object):
+    """ keeps one connection per uri and access mode open. connections which
+    died are reopened on next use. """
+    def __init__(self):
+        self.lock = threading.Lock()  # guards locks
+        self.locks = {}  # lock by key held while checking and opening
+        self.conns = {}
+
+    def open(self, uri, readonly):
+        key = (uri, bool(readonly))
+        with self.lock:  # opening other connections must not wait for this
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            conn = self.conns.get(key)
+            if conn is not None:
+                try:
+                    if conn.isAlive():
+                        return conn
+                except libvirt.libvirtError:
+                    pass
+                del self.conns[key]
+                try:
+                    conn.close()
+                except libvirt.libvirtError:
+                    pass
+            conn = libvirt.openReadOnly(uri) if readonly else \
+                libvirt.open(uri)
+            try:
+                conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            except libvirt.libvirtError:
+                pass  # local drivers do not support keepalive
+            self.conns[key] = conn
+            return conn
+
+    def dispatch(self, req, objs):
+        """ handles request of a session. objs holds the objects of the
+        session by reference. returns response. """
+        def encode(value):
+            if isinstance(value, (list, tuple)):
+                return [encode(v) for v in value]
+            elif isinstance(value, dict):
+                return dict((k, encode(v)) for k, v in value.items())
+            elif is_libvirt_object(value):
+                ref = id(value)  # unique as long as objs holds value
+                objs[ref] = value
+                return {'__ref__': ref, '__type__': type(value).__name__}
+            return value
+
+        def decode(value):
+            if isinstance(value, list):
+                return [decode(v) for v in value]
+            elif isinstance(value, dict):
+                if '__ref__' in value:
+                    return objs[value['__ref__']]
+                return dict((k, decode(v)) for k, v in value.items())
+            return value
+
+        try:
+            if req['op'] == 'open':
+                return {'ok': encode(self.open(req['uri'],
+                                               req.get('readonly')))}
+            elif req['op'] == 'call':
+                if req['method'].startswith('_') \
+                        or req['method'] in BLOCKED_METHODS:
+                    raise libvirt_error(libvirt.VIR_ERR_NO_SUPPORT, 0,
+                                        "method %s is not supported by the "
+                                        "connection broker" % req['method'])
+                if req['method'] in QEMU_METHODS:
+                    import libvirt_qemu
+                    method = functools.partial(
+                        getattr(libvirt_qemu, req['method']), objs[req['obj']])
+                else:
+                    method = getattr(objs[req['obj']], req['method'])
+                return {'ok': encode(method(*decode(req.get('args', []))))}
+            raise ValueError("unknown operation %s" % req['op'])
+        except libvirt.libvirtError as e:
+            return {'error': [e.get_error_code(), e.get_error_domain(),
+                              str(e)]}
+        except Exception as e:
+            return {'error': [libvirt.VIR_ERR_INTERNAL_ERROR, 0, str(e)]}
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    """ serves one session. objects of the session are dropped when the
+    client disconnects. """
+    def handle(self):
+        if not self.server.peer_allowed(self.request):
+            return
+        objs = {}
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                req = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            resp = self.server.broker.dispatch(req, objs)
+            try:
+                line = json.dumps(resp)
+            except (TypeError, ValueError) as e:  # results not encodable
+                line = json.dumps({'error': [
+                    libvirt.VIR_ERR_INTERNAL_ERROR, 0,
+                    "result can not be serialized: %s" % e]})
+            self.wfile.write((line + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+
+class BrokerServer(socketserver.ThreadingMixIn,
+                   socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        socketserver.UnixStreamServer.__init__(self, path, BrokerHandler)
+        self.broker = Broker()
+
+    def peer_allowed(self, sock):
+        """ only accept clients of the same user """
+        try:
+            creds = sock.getsockopt(socket.SOL_SOCKET,
+                                    getattr(socket, 'SO_PEERCRED', 17),
+                                    struct.calcsize('3i'))
+        except socket.error:
+            return True  # no peer credentials, rely on socket permissions
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+
+def serve(path):
+    """ runs the broker at socket path until it gets killed """
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d, 0o700)
+        os.chmod(d, 0o700)  # regardless of umask
+    if not broker_path_trusted(path):
+        raise BrokerError("%s or its directory belongs to another user or "
+                          "the directory is not of mode 0700" % path)
+    if os.path.exists(path):
+        try:
+            BrokerClient(path).close()
+        except socket.error:
+            os.unlink(path)  # stale socket
+        else:
+            raise BrokerError("broker already running at %s" % path)
+
+    # keepalive requires an event loop
+    libvirt.virEventRegisterDefaultImpl()
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+    t = threading.Thread(target=run, name="libvirt-events")
+    t.daemon = True
+    t.start()
+
+    server = BrokerServer(path)
+    os.chmod(path, 0o600)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(path)
+
+
+def main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="libvirt connection broker")
+    parser.add_argument('--socket', default=broker_socket_path(),
+                        help="path of the unix socket to listen on")
+    parser.add_argument('--daemon', action='store_true',
+                        help="detach from terminal")
+    args = parser.parse_args(argv)
+
+    if libvirt is None:
+        sys.exit("'libvirt' python library is missing on host.")
+    libvirt.registerErrorHandler(lambda x, y: None, 'ctx')
+    if args.daemon:
+        if os.fork():
+            return
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    serve(args.socket)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+""" connection and lookup helpers """
+
+from ansible.module_utils.virt_common import libvirt, libvirt_available
+
+
+def eh_dummy(x, y):
+    """ dummy error handler to supress error messages to stderr """
+    pass
+
+
+def virt_open(uri, readonly=False, broker=True):
+    """ opens connection to libvirt at uri. The connection broker is used if
+    it is running and 'broker' is set, otherwise a direct connection is
+    opened. """
+    conn = None
+    if broker:  # the broker client (sockets, json) is imported on demand
+        from ansible.module_utils.virt_common.broker import broker_open
+        conn = broker_open(uri, readonly)
+    if conn is None:
+        conn = libvirt.openReadOnly(uri) if readonly else libvirt.open(uri)
+    return conn
+
+
+def virt_connect(module, readonly=False, before_open=None):
+    """ connects to module.params['uri'] (using module.params['broker']) and
+    fails the module if that is not possible. before_open is called after
+    checking for libvirt but before connecting (e.g. to register an event
+    loop). """
+    if not libvirt_available():
+        module.fail_json(msg="'libvirt' python library is missing on host.")
+    libvirt.registerErrorHandler(eh_dummy, 'ctx')  # apply dummy error handler
+    if before_open:
+        before_open()
+
+    try:
+        conn = virt_open(module.params['uri'], readonly=readonly,
+                         broker=module.params['broker'])
+    except libvirt.libvirtError as e:
+        module.fail_json(msg=str(e), debug=e.get_error_code())
+    if not conn:
+        module.fail_json(msg="connection to libvirt failed.")
+    return conn
+
+
+def lookup(lookup_fn, name, missing_code):
+    """ returns lookup_fn(name) or None if libvirt reports error missing_code
+    (e.g. VIR_ERR_NO_DOMAIN). other errors are raised. """
+    try:
+        return lookup_fn(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() != missing_code:
+            raise
+        return None
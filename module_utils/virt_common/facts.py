@@ -0,0 +1,121 @@
+""" facts about all domains of a hypervisor, cached on local disk
+
+All domains and their statistics are fetched using a single
+getAllDomainStats call. Summaries of the domains definitions need one
+XMLDesc call per domain. They are kept in the cache by domain UUID, so
+while the cache is fresh invalidating some domains only reads the
+definitions of those and of domains not seen before. Once the cache
+expired all summaries are read again, as definitions may have changed.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from ansible.module_utils.virt_common import ET
+from ansible.module_utils.virt_common.state import state_name
+
+
+def facts_cache_path(cache_dir, uri, xml=True):
+    """ returns path of the cache file of hypervisor uri. facts without
+    summaries ('xml' False) are kept in a file of their own. """
+    key = hashlib.sha1(uri.encode('utf-8')).hexdigest()
+    return os.path.join(os.path.expanduser(cache_dir),
+                        key + ('.json' if xml else '.state.json'))
+
+
+def facts_cache_read(path):
+    """ returns cached data (dict of 'uri', 'time' and 'domains' by UUID) or
+    None if there is no readable cache """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def facts_cache_write(path, data):
+    """ writes data to cache file path atomically """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
+
+
+def xml_summary(root):
+    """ returns dict summarizing the domain definition root """
+    def attr(e, path, name):
+        c = e.find(path)
+        return c.get(name) if c is not None else None
+
+    memory = root.find('memory')
+    vcpu = root.find('vcpu')
+    return dict(
+        title=root.findtext('title'),
+        memory=int(memory.text) if memory is not None else None,
+        memory_unit=memory.get('unit', 'KiB') if memory is not None
+        else None,
+        vcpus=int(vcpu.text) if vcpu is not None else None,
+        interfaces=[dict(type=i.get('type'), mac=attr(i, 'mac', 'address'),
+                         network=attr(i, 'source', 'network'),
+                         bridge=attr(i, 'source', 'bridge'),
+                         model=attr(i, 'model', 'type'))
+                    for i in root.findall('devices/interface')],
+        disks=[dict(device=d.get('device'), target=attr(d, 'target', 'dev'),
+                    source=dict(d.find('source').attrib)
+                    if d.find('source') is not None else None)
+               for d in root.findall('devices/disk')],
+    )
+
+
+def domain_facts(conn, cached=None, xml=True):
+    """ returns dict of facts by UUID of all domains of conn. Definitions
+    are summarized unless 'xml' is False. summaries of cached (dict of facts
+    by UUID) are reused. """
+    cached = cached or {}
+    domains = {}
+    for dom, stats in conn.getAllDomainStats(0, 0):
+        uuid = dom.UUIDString()
+        state, strange = state_name(stats.get('state.state'))
+        facts = dict(name=dom.name(), uuid=uuid, state=state,
+                     strange=strange, stats=stats)
+        if xml:
+            summary = cached.get(uuid, {}).get('xml')
+            if summary is None:
+                summary = xml_summary(ET.fromstring(dom.XMLDesc(0)))
+            facts['xml'] = summary
+        domains[uuid] = facts
+    return domains
+
+
+def facts_collect(uri, connect, cache_dir=None, ttl=0, xml=True,
+                  invalidate=()):
+    """ returns tuple of dict of domain facts by name of hypervisor uri and
+    True if they were taken from the cache. connect() is called to get a
+    connection if the cache at cache_dir is missing, older than ttl seconds
+    or domains by UUID are to be invalidated. """
+    def fresh(data):
+        return data and time.time() - data.get('time', 0) < ttl
+
+    path = facts_cache_path(cache_dir, uri) if cache_dir else None
+    data = facts_cache_read(path) if path else None
+    if path and not xml and not (fresh(data) and not invalidate):
+        # a fresh cache including summaries will do, but facts without
+        # them are written to their own file to not drop the summaries
+        path = facts_cache_path(cache_dir, uri, xml=False)
+        data = facts_cache_read(path)
+    if fresh(data) and (data.get('xml') or not xml) and not invalidate:
+        return dict((d['name'], d) for d in data['domains'].values()), True
+
+    # summaries are reused only while the cache is fresh
+    cached = dict((uuid, d) for uuid, d in data['domains'].items()
+                  if uuid not in invalidate) if fresh(data) else {}
+    domains = domain_facts(connect(), cached, xml)
+    if path:
+        facts_cache_write(path, dict(uri=uri, time=time.time(), xml=xml,
+                                     domains=domains))
+    return dict((d['name'], d) for d in domains.values()), False
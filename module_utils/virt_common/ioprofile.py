@@ -0,0 +1,101 @@
+""" I/O tuning of disks and network interfaces of domain definitions
+
+Disks are classified by their backing storage: block devices (including
+volumes of pools backed by block devices like LVM) get native AIO, files
+(raw or qcow2) thread based I/O, which does not block while they grow. All
+of them bypass the host page cache and pass discards through, virtio disks
+are spread over iothreads. virtio interfaces get vhost with one queue per
+vcpu. Attributes and elements given by the definition are never changed.
+"""
+
+from ansible.module_utils.virt_common import libvirt, ET
+from ansible.module_utils.virt_common.connection import lookup
+
+# storage pool types whose volumes are block devices
+block_pools = ['logical', 'disk', 'iscsi', 'iscsi-direct', 'scsi', 'mpath',
+               'zfs']
+# storage pool types whose volumes are files
+file_pools = ['dir', 'fs', 'netfs']
+
+# driver attributes by storage class of disks
+disk_drivers = {
+    'block': dict(cache='none', io='native', discard='unmap'),
+    'file': dict(cache='none', io='threads', discard='unmap'),
+    'network': dict(discard='unmap'),
+}
+
+nic_queues_max = 8  # limit of queues of virtio interfaces
+
+
+def disk_storage(conn, disk, pools):
+    """ returns storage class ('block', 'file', 'network' or None if
+    unknown) of disk element. types of storage pools are looked up using
+    conn and kept in dict pools by name. """
+    kind = disk.get('type', 'file')
+    if kind in ('block', 'file', 'network'):
+        return kind
+    source = disk.find('source')
+    if kind != 'volume' or source is None or not source.get('pool'):
+        return None
+    name = source.get('pool')
+    if name not in pools:
+        pool = lookup(conn.storagePoolLookupByName, name,
+                      libvirt.VIR_ERR_NO_STORAGE_POOL)
+        pools[name] = ET.fromstring(pool.XMLDesc(0)).get('type') \
+            if pool else None
+    if pools[name] in block_pools:
+        return 'block'
+    if pools[name] in file_pools:
+        return 'file'
+    return 'network' if pools[name] else None
+
+
+def io_profile(conn, root):
+    """ fills in I/O tuning of disks (cache, io, discard and iothread) and
+    virtio interfaces (vhost and queues) of domain root depending on their
+    storage and the number of vcpus. alters root in place and returns it. """
+    vcpus = int(root.findtext('vcpu', '1').strip())
+    disks = [d for d in root.findall('devices/disk')
+             if d.get('device', 'disk') == 'disk']
+
+    pools = {}
+    for disk in disks:
+        settings = disk_drivers.get(disk_storage(conn, disk, pools), {})
+        driver = disk.find('driver')
+        if driver is None:
+            driver = ET.SubElement(disk, 'driver', name='qemu')
+        for attr, value in sorted(settings.items()):  # cache before io
+            if driver.get(attr) is not None:
+                continue
+            if value == 'native' and \
+                    driver.get('cache') not in ('none', 'directsync'):
+                continue  # native AIO requires O_DIRECT
+            driver.set(attr, value)
+
+    virtio = [d for d in disks if d.find('target') is not None and
+              d.find('target').get('bus') == 'virtio']
+    if virtio:
+        iothreads = root.find('iothreads')
+        if iothreads is None:
+            iothreads = ET.Element('iothreads')
+            iothreads.text = str(min(len(virtio), vcpus))
+            root.insert(list(root).index(root.find('vcpu')) + 1
+                        if root.find('vcpu') is not None else 0, iothreads)
+        count = int(iothreads.text)
+        for i, disk in enumerate(virtio):
+            driver = disk.find('driver')
+            if count and driver.get('iothread') is None:
+                driver.set('iothread', str(i % count + 1))
+
+    for nic in root.findall('devices/interface'):
+        model = nic.find('model')
+        if model is None or model.get('type') != 'virtio':
+            continue
+        driver = nic.find('driver')
+        if driver is None:
+            driver = ET.SubElement(nic, 'driver')
+        if driver.get('name') is None:
+            driver.set('name', 'vhost')
+        if driver.get('queues') is None and vcpus > 1:
+            driver.set('queues', str(min(vcpus, nic_queues_max)))
+    return root
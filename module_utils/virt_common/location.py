@@ -0,0 +1,35 @@
+""" index of the hypervisors domains are defined on """
+
+from ansible.module_utils.virt_common.facts import facts_collect
+
+
+def hypervisors_query(hypervisors, query, workers=8):
+    """ returns list of (name, query(uri)) of hypervisors (dict of libvirt
+    URIs by name) sorted by name. up to workers hypervisors are queried in
+    parallel. """
+    from multiprocessing.pool import ThreadPool  # only needed here
+
+    items = sorted(hypervisors.items())
+    pool = ThreadPool(max(1, min(workers, len(items))))
+    try:
+        return pool.map(lambda item: (item[0], query(item[1])), items)
+    finally:
+        pool.close()
+
+
+def location_index(hypervisors, connect, cache_dir=None, ttl=0, workers=8):
+    """ returns dict of lists of (hypervisor, facts) by domain name and by
+    UUID. hypervisors is a dict of libvirt URIs by name. All hypervisors are
+    queried in parallel using one bulk call each, connect(uri) is called to
+    open connections. Results are cached like facts (see facts_collect). """
+    def query(uri):
+        domains, _ = facts_collect(uri, lambda: connect(uri), cache_dir, ttl,
+                                   xml=False)
+        return domains
+
+    index = {}
+    for hv, domains in hypervisors_query(hypervisors, query, workers):
+        for name, facts in domains.items():
+            index.setdefault(name, []).append((hv, facts))
+            index.setdefault(facts['uuid'], []).append((hv, facts))
+    return index
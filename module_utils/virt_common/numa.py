@@ -0,0 +1,166 @@
+""" NUMA aware pinning of domains
+
+The host topology is taken from its capabilities, the cpus and memory of
+the NUMA cells already used by other domains from their vcpupin and
+numatune definitions. A domain is put on the least loaded cell having
+enough free cpus and memory, spanning several cells only if no single one
+suffices. Hyperthread siblings are handed out next to each other.
+"""
+
+from ansible.module_utils.virt_common import ET
+from ansible.module_utils.virt_common.xmlutil import unit_factors
+
+
+def cpuset_parse(cpuset):
+    """ returns set of cpus of a libvirt cpuset like '0-3,^2,8' """
+    cpus = set()
+    excluded = set()
+    for part in cpuset.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        target = cpus
+        if part.startswith('^'):
+            target = excluded
+            part = part[1:]
+        first, _, last = part.partition('-')
+        target.update(range(int(first), int(last or first) + 1))
+    return cpus - excluded
+
+
+def cpuset_format(cpus):
+    """ returns cpuset of cpus using ranges """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "%d-%d" % (a, b) for a, b in ranges)
+
+
+def xml_memory(e):
+    """ returns size in KiB of memory element e (0 if None) """
+    if e is None or not (e.text or "").strip().isdigit():
+        return 0
+    return int(e.text) * unit_factors.get(e.get('unit', 'KiB').lower(),
+                                          1024) // 1024
+
+
+def host_cells(caps):
+    """ returns list of NUMA cells of host capabilities root as dicts of
+    'id', 'memory' (KiB) and 'cpus' (list of cpu ids, siblings next to each
+    other) """
+    cells = []
+    for cell in caps.findall('host/topology/cells/cell'):
+        cpus = sorted(cell.findall('cpus/cpu'), key=lambda c: (
+            int(c.get('socket_id', 0)), int(c.get('core_id', 0)),
+            int(c.get('id'))))
+        cells.append(dict(id=int(cell.get('id')),
+                          memory=xml_memory(cell.find('memory')),
+                          cpus=[int(c.get('id')) for c in cpus]))
+    return cells
+
+
+def pinning_used(conn, skip=None):
+    """ returns tuple of set of cpus vcpus are pinned to and dict of memory
+    (KiB) bound by NUMA cell of all domains of conn except the one of UUID
+    skip """
+    cpus = set()
+    memory = {}
+    for dom in conn.listAllDomains(0):
+        if dom.UUIDString() == skip:
+            continue
+        root = ET.fromstring(dom.XMLDesc(0))
+        for pin in root.findall('cputune/vcpupin'):
+            cpus |= cpuset_parse(pin.get('cpuset', ''))
+        bound = root.find('numatune/memory')
+        if bound is not None and bound.get('nodeset'):
+            nodes = cpuset_parse(bound.get('nodeset'))
+            size = xml_memory(root.find('memory'))
+            for node in nodes:
+                memory[node] = memory.get(node, 0) + size // len(nodes)
+    return cpus, memory
+
+
+def numa_plan(cells, used_cpus, used_memory, vcpus, memory):
+    """ returns list of (cell id, cpus, memory) to place a domain of vcpus
+    and memory (KiB) on or None if the cells lack free resources """
+    candidates = []
+    for cell in cells:
+        free = [cpu for cpu in cell['cpus'] if cpu not in used_cpus]
+        load = 1 - float(len(free)) / len(cell['cpus']) if cell['cpus'] \
+            else 1
+        candidates.append((load, cell['id'], free,
+                           cell['memory'] - used_memory.get(cell['id'], 0)))
+    candidates.sort(key=lambda c: c[:2])
+
+    for _, cell, free, left in candidates:
+        if len(free) >= vcpus and left >= memory:
+            return [(cell, free[:vcpus], memory)]
+
+    plan = []
+    missing = vcpus
+    for _, cell, free, left in candidates:
+        count = min(len(free), missing)
+        # shares are rounded to MiB, the last cell gets the rest
+        size = memory * count // vcpus // 1024 * 1024 if count < missing \
+            else memory - sum(p[2] for p in plan)
+        if count and left >= size:
+            plan.append((cell, free[:count], size))
+            missing -= count
+        if not missing:
+            return plan
+    return None
+
+
+def numa_merge(conn, root, uuid=None):
+    """ adds vcpu and emulator pinning, numatune and a guest NUMA topology
+    placing domain root on the least loaded NUMA cells of the host of conn,
+    ignoring the domain of UUID uuid. parts already given by root are kept,
+    nothing is added if root pins vcpus. alters root in place and returns
+    it, raises ValueError if the cells lack free resources. """
+    if root.find('cputune/vcpupin') is not None:
+        return root
+    vcpus = int(root.findtext('vcpu', '1').strip())
+    memory = xml_memory(root.find('memory'))
+    cells = host_cells(ET.fromstring(conn.getCapabilities()))
+    used_cpus, used_memory = pinning_used(conn, uuid)
+    plan = numa_plan(cells, used_cpus, used_memory, vcpus, memory)
+    if plan is None:
+        raise ValueError("no NUMA cells with %d free cpus and %d KiB of "
+                         "memory left." % (vcpus, memory))
+
+    cputune = root.find('cputune')
+    if cputune is None:
+        cputune = ET.SubElement(root, 'cputune')
+    vcpu = 0
+    for _, cpus, _ in plan:
+        for cpu in cpus:
+            ET.SubElement(cputune, 'vcpupin', vcpu=str(vcpu), cpuset=str(cpu))
+            vcpu += 1
+    if cputune.find('emulatorpin') is None:
+        ET.SubElement(cputune, 'emulatorpin', cpuset=cpuset_format(
+            cpu for _, cpus, _ in plan for cpu in cpus))
+
+    nodeset = cpuset_format(cell for cell, _, _ in plan)
+    if root.find('numatune') is None:
+        numatune = ET.SubElement(root, 'numatune')
+        ET.SubElement(numatune, 'memory', mode='strict', nodeset=nodeset)
+        if len(plan) > 1:
+            for guest, (cell, _, _) in enumerate(plan):
+                ET.SubElement(numatune, 'memnode', cellid=str(guest),
+                              mode='strict', nodeset=str(cell))
+
+    cpu = root.find('cpu')
+    if cpu is None:
+        cpu = ET.SubElement(root, 'cpu')
+    if cpu.find('numa') is None:
+        numa = ET.SubElement(cpu, 'numa')
+        first = 0
+        for guest, (_, cpus, size) in enumerate(plan):
+            ET.SubElement(numa, 'cell', id=str(guest), cpus=cpuset_format(
+                range(first, first + len(cpus))), memory=str(size),
+                unit='KiB')
+            first += len(cpus)
+    return root
@@ -0,0 +1,150 @@
+""" placement of domains on hypervisors by free resources
+
+Free resources of all hypervisors are queried at once (see host_resources),
+then all pending domains are placed together: largest first, each on a
+fitting hypervisor chosen by strategy. 'pack' takes the one left with the
+least free memory (best fit), 'spread' the one left with the most. Hosts
+able to back a domain by the free memory of a single NUMA cell are preferred
+in both cases.
+"""
+
+from ansible.module_utils.virt_common import libvirt, ET
+from ansible.module_utils.virt_common.state import state_name
+from ansible.module_utils.virt_common.xmlutil import unit_factors
+
+
+def host_resources(conn):
+    """ returns dict of resources of the hypervisor of conn: 'cpus',
+    'vcpus' (sum of vcpus of running domains), 'memory' (free KiB), 'cells'
+    (list of free KiB by NUMA cell), 'hugepages' (dict of free pages by size
+    in KiB) and 'domains' (dict of state by name) """
+    cpus = conn.getInfo()[2]
+    caps = ET.fromstring(conn.getCapabilities())
+    cells = caps.findall('host/topology/cells/cell')
+    ncells = max(len(cells), 1)
+    sizes = sorted(set(int(p.get('size')) for c in cells
+                       for p in c.findall('pages')))
+    hugepages = {}
+    if len(sizes) > 1:  # the smallest size are the normal pages
+        for pages in conn.getFreePages(sizes[1:], 0, ncells).values():
+            for size, count in pages.items():
+                hugepages[int(size)] = hugepages.get(int(size), 0) + count
+
+    vcpus = 0
+    domains = {}
+    for dom, stats in conn.getAllDomainStats(
+            libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU,
+            0):
+        state, _ = state_name(stats.get('state.state'))
+        domains[dom.name()] = state
+        if state in ('running', 'paused'):
+            vcpus += stats.get('vcpu.current', 0)
+
+    return dict(cpus=cpus, vcpus=vcpus,
+                memory=conn.getFreeMemory() // 1024,
+                cells=[m // 1024 for m in
+                       conn.getCellsFreeMemory(0, ncells)],
+                hugepages=hugepages, domains=domains)
+
+
+def spec_normalize(spec):
+    """ returns domain spec (dict of 'name', 'memory', optionally
+    'memory_unit' (default KiB), 'vcpus' and 'hugepages') with memory in KiB
+    and hugepages as page size in KiB, True for the smallest huge page size
+    of a host or 0 if not backed by huge pages """
+    unit = spec.get('memory_unit', 'KiB')
+    if unit.lower() not in unit_factors:
+        raise ValueError("unsupported memory unit %s of %s." %
+                         (unit, spec['name']))
+    factor = unit_factors[unit.lower()]
+    hugepages = spec.get('hugepages') or 0
+    return dict(name=spec['name'],
+                memory=int(spec['memory']) * factor // 1024,
+                vcpus=int(spec.get('vcpus', 1)),
+                hugepages=hugepages if hugepages is True else int(hugepages))
+
+
+def page_size(host, spec):
+    """ returns huge page size backing spec on host, 0 if none and None if
+    host has no pages of the size required """
+    size = spec['hugepages']
+    if size is True:
+        size = min(host['hugepages']) if host['hugepages'] else None
+    elif size and size not in host['hugepages']:
+        size = None
+    return size
+
+
+def host_fit(host, spec, cpu_ratio, reserve):
+    """ returns memory (KiB) left on host after placing spec there or None if
+    it does not fit """
+    if host['vcpus'] + spec['vcpus'] > host['cpus'] * cpu_ratio:
+        return None
+    size = page_size(host, spec)
+    if size is None:
+        return None
+    if size:
+        left = host['hugepages'][size] * size - spec['memory']
+    else:
+        left = host['memory'] - reserve - spec['memory']
+    return left if left >= 0 else None
+
+
+def host_consume(host, spec):
+    """ subtracts resources of spec from host """
+    host['vcpus'] += spec['vcpus']
+    size = page_size(host, spec)
+    if size:
+        host['hugepages'][size] -= -(-spec['memory'] // size)
+        return
+    host['memory'] -= spec['memory']
+    if host['cells']:  # the smallest cell fitting or the largest one
+        fitting = [m for m in host['cells'] if m >= spec['memory']]
+        cell = host['cells'].index(min(fitting) if fitting
+                                   else max(host['cells']))
+        host['cells'][cell] = max(host['cells'][cell] - spec['memory'], 0)
+
+
+def placement_plan(hosts, specs, strategy='pack', cpu_ratio=4.0,
+                   reserve=1048576):
+    """ returns tuple of dict of host names by domain name and list of
+    domains not fitting anywhere. hosts is a dict of host_resources by name,
+    which are updated. specs are normalized domain specs (see
+    spec_normalize). domains already defined stay on their host, raises
+    ValueError if one is defined on several hosts. reserve is the memory
+    (KiB) kept free on each host, cpu_ratio the vcpus allowed per cpu. """
+    plan = {}
+    pending = []
+    for spec in specs:
+        owners = sorted(h for h in hosts
+                        if spec['name'] in hosts[h]['domains'])
+        if len(owners) > 1:
+            raise ValueError("domain %s is defined on %s." %
+                             (spec['name'], ", ".join(owners)))
+        if not owners:
+            pending.append(spec)
+            continue
+        host = hosts[owners[0]]
+        if host['domains'][spec['name']] not in ('running', 'paused'):
+            host_consume(host, spec)  # to be started there
+        plan[spec['name']] = owners[0]
+
+    unplaced = []
+    for spec in sorted(pending, key=lambda s: (s['memory'], s['vcpus']),
+                       reverse=True):
+        best = None
+        for name in sorted(hosts):
+            left = host_fit(hosts[name], spec, cpu_ratio, reserve)
+            if left is None:
+                continue
+            cell = page_size(hosts[name], spec) or \
+                any(m >= spec['memory'] for m in hosts[name]['cells'])
+            key = (not cell, left if strategy == 'pack' else -left)
+            if best is None or key < best[0]:
+                best = (key, name)
+        if best is None:
+            unplaced.append(spec['name'])
+            continue
+        host_consume(hosts[best[1]], spec)
+        plan[spec['name']] = best[1]
+    return plan, unplaced
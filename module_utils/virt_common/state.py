@@ -0,0 +1,162 @@
+""" domain state helpers shared by virt_domain and virt_domain_wait """
+
+import json
+import threading
+import time
+
+from ansible.module_utils.virt_common import libvirt, libvirt_qemu
+
+
+def state_name(code):
+    ''' returns tuple (state, strange) of libvirt state code (e.g.
+        VIR_DOMAIN_RUNNING) as described by dom_state. '''
+
+    # notice that there is no "undefined" state returned here since that
+    # causes the domain to be nonexistent.
+    states = {
+        libvirt.VIR_DOMAIN_NOSTATE: ('running', True),
+        libvirt.VIR_DOMAIN_BLOCKED: ('running', True),
+        libvirt.VIR_DOMAIN_RUNNING: ('running', False),
+        libvirt.VIR_DOMAIN_PAUSED: ('paused', False),
+        libvirt.VIR_DOMAIN_SHUTDOWN: ('defined', False),
+        libvirt.VIR_DOMAIN_SHUTOFF: ('defined', False),
+        libvirt.VIR_DOMAIN_CRASHED: ('unknown', True),
+        libvirt.VIR_DOMAIN_PMSUSPENDED: ('unknown', True),
+    }
+    return states.get(code, ('unknown', True))
+
+
+def dom_state(domain):
+    ''' receives state of domain by domain handle. If a falsey domain handle
+        is given (e.g. None) state 'undefined' is emitted.
+        returns: Tuple of (state, strange), where state is the domains state
+            and strange is True if libvirt returns a state like 'blocked' or
+            'pmsuspended'. However, those states should never appear.
+            A shut off domain having a managed save image is 'saved'. '''
+    if not domain:
+        return 'undefined', False
+
+    dom_state, _ = domain.state()  # get domain state from libvirt
+    if dom_state == libvirt.VIR_DOMAIN_SHUTOFF and \
+            domain.hasManagedSaveImage(0):
+        return 'saved', False
+    return state_name(dom_state)
+
+
+# seconds to wait for an answer of the guest agent
+agent_timeout = 2
+agent_probe_timeout = 1  # seconds a ping waits while polling many domains
+
+
+def agent_command(domain, command, timeout=agent_timeout):
+    """ sends command to the qemu guest agent of domain. returns its
+    'return' value or None if the agent does not answer (e.g. the guest did
+    not boot yet or there is no agent channel). """
+    command = json.dumps(dict(execute=command))
+    try:
+        if hasattr(domain, 'qemuAgentCommand'):  # proxy of the broker
+            reply = domain.qemuAgentCommand(command, timeout, 0)
+        else:
+            reply = libvirt_qemu.qemuAgentCommand(domain, command, timeout, 0)
+    except libvirt.libvirtError:
+        return None
+    return json.loads(reply).get('return')
+
+
+def agent_ready(domain, timeout=agent_timeout):
+    """ returns True if the guest agent of domain answers a ping """
+    return agent_command(domain, 'guest-ping', timeout) is not None
+
+
+def agents_ready(domains, command=None, timeout=agent_probe_timeout):
+    """ returns list of (domain, answer to command or None) of those domains
+    whose guest agent answers a ping. the agents are asked concurrently, so
+    waiting for them does not add up. """
+    def probe(domain):
+        if not agent_ready(domain, timeout):
+            return None
+        return (domain, agent_command(domain, command, timeout)
+                if command else None)
+
+    if len(domains) < 2:
+        answers = [probe(d) for d in domains]
+    else:
+        from multiprocessing.pool import ThreadPool  # only needed here
+        pool = ThreadPool(min(len(domains), 16))
+        try:
+            answers = pool.map(probe, domains)
+        finally:
+            pool.close()
+    return [a for a in answers if a is not None]
+
+
+# monotonic clock for deadlines (python 2 lacks time.monotonic)
+monotonic = getattr(time, 'monotonic', time.time)
+event_loop_running = False
+
+
+def event_loop_start():
+    """ registers the default libvirt event loop implementation and runs it
+    inside a daemon thread. This has to be done before opening connections
+    which should deliver events. returns False if events are unavailable. """
+    global event_loop_running
+    if event_loop_running:
+        return True
+    try:
+        libvirt.virEventRegisterDefaultImpl()
+    except (AttributeError, libvirt.libvirtError):
+        return False
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+    t = threading.Thread(target=run, name="libvirt-events")
+    t.daemon = True
+    t.start()
+    event_loop_running = True
+    return True
+
+
+def wait_for(conn, domain_handle, reached, timeout, sleep=10,
+             events=('VIR_DOMAIN_EVENT_ID_LIFECYCLE',), backoff=False):
+    """ waits until reached() returns True or timeout seconds passed. The
+    condition is checked on each event (names of libvirt event ids) of
+    domain_handle (any domain if None) and at least every 'sleep' seconds.
+    If events are unavailable or 'backoff' is set the condition is polled
+    with exponential backoff up to 'sleep' seconds.
+    returns result of the last call to reached(). """
+    deadline = monotonic() + timeout
+    changed = threading.Event()
+
+    def on_event(conn, dom, event, detail, opaque):
+        changed.set()
+
+    cb_ids = []
+    if event_loop_running:
+        for event in events:
+            try:
+                cb_ids.append(conn.domainEventRegisterAny(
+                    domain_handle, getattr(libvirt, event), on_event, None))
+            except (AttributeError, libvirt.libvirtError):
+                pass  # unknown to this libvirt version
+
+    delay = 0.1
+    try:
+        while True:
+            changed.clear()  # clear before checking to not miss any event
+            if reached():
+                return True
+            left = deadline - monotonic()
+            if left <= 0:
+                return False
+            if cb_ids:
+                changed.wait(min(left, delay if backoff else sleep))
+            else:
+                time.sleep(min(left, delay))
+            delay = min(delay * 2, sleep)
+    finally:
+        for cb_id in cb_ids:
+            try:
+                conn.domainEventDeregisterAny(cb_id)
+            except libvirt.libvirtError:
+                pass
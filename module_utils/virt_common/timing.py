@@ -0,0 +1,59 @@
+""" per phase timings of module runs """
+
+import collections
+import contextlib
+
+from ansible.module_utils.virt_common.state import monotonic
+
+
+class Timings(object):
+    """ sums up the duration of named phases using a monotonic clock. A
+    disabled instance records nothing. If profile_path is given the run is
+    profiled using cProfile and the statistics are written to that path. """
+
+    def __init__(self, enabled=False, profile_path=None):
+        self.enabled = enabled
+        self.phases = collections.OrderedDict()  # name -> seconds
+        self.start = monotonic()
+        self.profile_path = profile_path
+        self.profiler = None
+        if profile_path:
+            import cProfile  # only needed if profiling
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ context manager adding the time spent inside to phase name """
+        if not self.enabled:
+            yield
+            return
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + monotonic() - start
+
+    def report(self, result):
+        """ adds timings to result dict (key 'timings') if enabled and writes
+        profile. returns result. """
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+            self.profiler = None
+        if self.enabled:
+            timings = dict((k, round(v, 6)) for k, v in self.phases.items())
+            timings['total'] = round(monotonic() - self.start, 6)
+            result['timings'] = timings
+        return result
+
+
+def module_timings(module):
+    """ returns Timings configured by module parameters 'timings' and
+    'profile_out_path' """
+    return Timings(module.params['timings'],
+                   module.params['profile_out_path'])
+
+
+# disabled instance used if no timings are given
+no_timings = Timings()
@@ -0,0 +1,485 @@
+""" helpers comparing and altering xml element trees.
+
+The desired tree (left) is compared with the current tree (right) by
+xml_diff, which returns an edit script applied by xml_apply_edits. Elements
+of the desired tree are contained by the current tree if there are no edits:
+additional attributes and elements on the right side are kept.
+"""
+
+import collections
+import hashlib
+
+from ansible.module_utils.virt_common import ET
+
+
+def xml_by_tag_and_text(e):
+    """ returns dict of (tag -> list of tags) in e. """
+    r = {}
+    for i in e:
+        if i.tag not in r:
+            r[i.tag] = []
+        r[i.tag] += [i]
+    return r
+
+
+def xml_text(e):
+    """ gets all direct text inside element. text between child elements is
+    appended, therefore text always appears in front of children. """
+    t = e.text.strip() if e.text else ""  # text summary
+    for i in e:
+        t += i.tail.strip() if i.tail else ""
+    return t
+
+
+# edit script entry produced by xml_diff: 'op' is one of 'attr' (set
+# attribute 'key' to 'value'), 'text' (replace text by 'value'), 'append'
+# (append subtree 'value') or 'remove' (remove the element, 'value' is the
+# removed subtree). 'path' is the tuple of child indices leading from the
+# root of the current tree to the element to edit. 'ignored' edits are
+# applied along with other edits but do not require a change on their own.
+XmlEdit = collections.namedtuple('XmlEdit', 'op path key value ignored')
+
+
+class XmlRules(object):
+    """ compiled ignore and section rules for one element of a tree. Rules
+    are selectors relative to the root element like 'os/nvram' (element) or
+    'devices/interface/boot@order' (attribute), '*' matches any tag.
+    Rules form a trie indexed by tag, so looking up the rules of a child
+    costs a dict lookup. Children without rules share a single node.
+
+    'attrs': names of ignored attributes
+    'ignore': differences inside the subtree do not require a change
+    'prune': the subtree is left out of comparison
+    'exclusive': elements of the current tree not matched by the desired tree
+        are removed
+    'managed': attributes and text of the element are compared. False for
+        elements containing a section but not being part of one.
+    'restricted': children without rules are pruned (outside of sections)
+    'outside': the element neither is part of nor contains a section """
+
+    def __init__(self):
+        self.children = {}
+        self.attrs = set()
+        self.ignore = False
+        self.prune = False
+        self.exclusive = False
+        self.section = False
+        self.managed = True
+        self.restricted = False
+        self.outside = False
+        self._cache = {}
+
+    def add(self, path):
+        """ returns node for path (list of tags) creating missing nodes """
+        node = self
+        for tag in path:
+            node = node.children.setdefault(tag, XmlRules())
+        return node
+
+    def merge(self, other):
+        """ returns new node combining rules of self and other """
+        n = XmlRules()
+        n.attrs = self.attrs | other.attrs
+        n.ignore = self.ignore or other.ignore
+        n.prune = self.prune or other.prune
+        n.exclusive = self.exclusive or other.exclusive
+        n.section = self.section or other.section
+        n.managed = self.managed or other.managed
+        n.restricted = self.restricted and other.restricted
+        n.outside = self.outside and other.outside
+        n.children = dict(self.children)
+        for tag, c in other.children.items():
+            n.children[tag] = n.children[tag].merge(c) \
+                if tag in n.children else c
+        return n
+
+    def child(self, tag):
+        """ returns rules of child element tag or None if it is pruned """
+        try:
+            return self._cache[tag]
+        except KeyError:
+            pass
+        exact = self.children.get(tag)
+        wild = self.children.get('*')
+        if exact is not None and wild is not None:
+            node = exact.merge(wild)
+        else:
+            node = exact if exact is not None else wild
+        if node is None:
+            node = None if self.restricted else \
+                xml_rules_ignore_all if self.ignore else xml_rules_none
+        else:
+            if not self.restricted and node.restricted:
+                # part of a section, even if reached by a wildcard
+                node = node.merge(xml_rules_none)
+            if self.ignore and not node.ignore:
+                node = node.merge(xml_rules_ignore_all)
+            if node.prune or node.outside:
+                node = None
+        self._cache[tag] = node
+        return node
+
+
+def xml_rules_finish(node, inside):
+    """ sets 'managed', 'restricted' and 'outside' of node and its children.
+    'inside' is True if node is part of a section. returns True if node is
+    part of or contains a section. """
+    contains = False
+    for c in node.children.values():
+        contains = xml_rules_finish(c, inside or c.section) or contains
+    node.managed = inside
+    node.restricted = not inside
+    node.outside = not (inside or contains)
+    return inside or contains
+
+
+def xml_rules_parse(selector):
+    """ splits selector 'a/b@attr' into (['a', 'b'], 'attr') """
+    path, _, attr = selector.partition('@')
+    return [t for t in path.strip().split('/') if t], attr.strip() or None
+
+
+def xml_rules(ignore=(), prune=(), sections=(), exclusive=()):
+    """ compiles lists of selectors into rules for the root element. Elements
+    selected by 'ignore' are ignored including their subtree, attributes
+    selected by it are ignored. Elements selected by 'prune' are not compared
+    at all. If 'sections' are given, only elements selected by them are
+    compared. Elements selected by 'exclusive' are removed from the current
+    tree unless the desired tree contains them. """
+    key = (tuple(ignore), tuple(prune), tuple(sections), tuple(exclusive))
+    if key in xml_rules_cache:
+        return xml_rules_cache[key]
+    root = XmlRules()
+    for selector in ignore:
+        path, attr = xml_rules_parse(selector)
+        node = root.add(path)
+        if attr:
+            node.attrs.add(attr)
+        else:
+            node.ignore = True
+    for selector in prune:
+        path, attr = xml_rules_parse(selector)
+        if attr:
+            raise ValueError("can not prune attribute: %s" % selector)
+        root.add(path).prune = True
+    for selector in exclusive:
+        path, attr = xml_rules_parse(selector)
+        if attr or not path:
+            raise ValueError("exclusive must select an element: %s" %
+                             selector)
+        root.add(path).exclusive = True
+    for selector in sections:
+        path, attr = xml_rules_parse(selector)
+        if attr:
+            raise ValueError("section must select an element: %s" % selector)
+        root.add(path).section = True
+    if sections:
+        xml_rules_finish(root, root.section)
+    xml_rules_cache[key] = root
+    return root
+
+
+xml_rules_cache = {}
+
+# shared rules of elements without any rule and of ignored subtrees
+xml_rules_none = XmlRules()
+xml_rules_none._cache = collections.defaultdict(lambda: xml_rules_none)
+xml_rules_ignore_all = XmlRules()
+xml_rules_ignore_all.ignore = True
+xml_rules_ignore_all._cache = \
+    collections.defaultdict(lambda: xml_rules_ignore_all)
+
+
+def xml_shape(e, rules=None):
+    """ returns a hashable description of the parts of e which are used for
+    matching: tag, attribute names and shapes of children. Ignored attributes
+    and children are left out. Returns None if e has repeated child tags since
+    those can't be matched by fingerprint. """
+    rules = rules or xml_rules_none
+    if rules.ignore:
+        return (e.tag, (), False, ())
+    attrs = tuple(sorted(k for k in e.attrib if k not in rules.attrs)) \
+        if rules.managed else ()
+    by_tag = xml_by_tag_and_text(e)
+    children = []
+    for tag in sorted(by_tag):
+        c_rules = rules.child(tag)
+        if c_rules is None:
+            continue
+        if len(by_tag[tag]) != 1:
+            return None
+        shape = xml_shape(by_tag[tag][0], c_rules)
+        if shape is None:
+            return None
+        children.append(shape)
+    return (e.tag, attrs, rules.managed, tuple(children))
+
+
+def xml_fingerprint(e, shape):
+    """ canonical digest of element e projected on 'shape' (see xml_shape).
+    Elements sharing a fingerprint are equal regarding all parts of the
+    shape, additional attributes or children of e are not considered.
+    Returns None if e is missing a child required by shape or has it more
+    than once. """
+    tag, attrs, text, children = shape
+    by_tag = xml_by_tag_and_text(e)
+    fps = []
+    for c in children:
+        if len(by_tag.get(c[0], [])) != 1:
+            return None
+        fp = xml_fingerprint(by_tag[c[0]][0], c)
+        if fp is None:
+            return None
+        fps.append(fp)
+    key = (tag, tuple(e.get(a) for a in attrs),
+           xml_text(e) if text else None, tuple(fps))
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def xml_score(left, right, rules=None):
+    """ counts attributes, text and children of left which are matched by
+    right. used to find the best partial match. """
+    rules = rules or xml_rules_none
+    if rules.ignore:
+        return 0
+    score = 0
+    if rules.managed:
+        score = sum(1 for k, v in left.attrib.items()
+                    if k not in rules.attrs and right.get(k) == v)
+        if xml_text(left) and xml_text(left) == xml_text(right):
+            score += 1
+    r_by_tag = xml_by_tag_and_text(right)
+    for l in left:
+        c_rules = rules.child(l.tag)
+        if c_rules is not None and l.tag in r_by_tag:
+            score += 1 + max(xml_score(l, r, c_rules)
+                             for r in r_by_tag[l.tag])
+    return score
+
+
+def xml_match(lefts, rights, rules=None):
+    """ assigns each element of lefts at most one element of rights and vice
+    versa. Elements are matched by fingerprint first, remaining elements are
+    assigned by best partial match.
+    returns list of (right element or None, exact) in order of lefts """
+    res = [(None, False)] * len(lefts)
+    used = set()
+
+    # exact matches: bucket rights by fingerprint once per distinct shape
+    buckets = {}
+    for i, l in enumerate(lefts):
+        shape = xml_shape(l, rules)
+        if shape is None:
+            continue
+        if shape not in buckets:
+            b = buckets[shape] = {}
+            for j, r in enumerate(rights):
+                fp = xml_fingerprint(r, shape)
+                if fp is not None:
+                    b.setdefault(fp, collections.deque()).append(j)
+        candidates = buckets[shape].get(xml_fingerprint(l, shape))
+        while candidates:
+            j = candidates.popleft()
+            if j not in used:
+                used.add(j)
+                res[i] = (rights[j], True)
+                break
+
+    # leftovers: find best partial match among unused rights
+    for i, l in enumerate(lefts):
+        if res[i][0] is not None:
+            continue
+        best, best_score = None, 0
+        for j, r in enumerate(rights):
+            if j in used:
+                continue
+            score = xml_score(l, r, rules)
+            if score > best_score:
+                best, best_score = j, score
+        if best is not None:
+            used.add(best)
+            res[i] = (rights[best], False)
+    return res
+
+
+def xml_diff(left, right, rules=None, path=(), edits=None):
+    ''' compares desired tree left with current tree right in a single walk
+    without altering any of them. returns ordered list of XmlEdit which
+    transforms right into a tree containing left. 'rules' are the compiled
+    rules (see xml_rules) of left. '''
+    assert left.tag == right.tag
+    if edits is None:
+        edits = []
+    rules = rules or xml_rules_none
+
+    if rules.managed:
+        # parse attribute equality
+        for lk, lv in sorted(left.attrib.items()):
+            if right.get(lk) != lv:
+                edits.append(XmlEdit('attr', path, lk, lv,
+                                     rules.ignore or lk in rules.attrs))
+
+        # compare text. text between elements is aggregated in front of them.
+        l_text = xml_text(left)
+        if l_text != xml_text(right):
+            edits.append(XmlEdit('text', path, None, l_text, rules.ignore))
+
+    # sort elements by tag on each side
+    l_by_tag = xml_by_tag_and_text(left)
+    r_by_tag = xml_by_tag_and_text(right)
+    r_index = dict((id(r), i) for i, r in enumerate(right))
+
+    matches = {}  # tag -> iterator over matches of repeated elements
+    matched = set()  # ids of matched right elements
+    for l in left:
+        c_rules = rules.child(l.tag)
+        if c_rules is None:  # pruned
+            continue
+        rs = r_by_tag.get(l.tag, [])
+        if len(l_by_tag[l.tag]) == 1 and len(rs) == 1:
+            # 1:1 tag match so alter this element instead of adding a new one
+            r = rs[0]
+        else:
+            # got multiple elements: match each left element to at most one
+            # right element. left elements without a match are added to the
+            # right side.
+            if l.tag not in matches:
+                matches[l.tag] = iter(xml_match(l_by_tag[l.tag], rs, c_rules))
+            r, _ = next(matches[l.tag])
+        if r is None:
+            edits.append(XmlEdit('append', path, None, l, c_rules.ignore))
+        else:
+            matched.add(id(r))
+            xml_diff(l, r, c_rules, path + (r_index[id(r)],), edits)
+
+    # remove unmatched elements of exclusive tags
+    for r in right:
+        c_rules = rules.child(r.tag)
+        if c_rules is not None and c_rules.exclusive and id(r) not in matched:
+            edits.append(XmlEdit('remove', path + (r_index[id(r)],), None, r,
+                                 c_rules.ignore))
+    return edits
+
+
+def xml_changed(edits):
+    """ returns True if edit script contains edits which are not ignored """
+    return any(not e.ignored for e in edits)
+
+
+def xml_apply_edits(right, edits):
+    """ applies edit script generated by xml_diff to tree right. """
+    removals = []
+    for e in edits:
+        if e.op == 'remove':  # removed last to keep paths valid
+            removals.append(e.path)
+            continue
+        node = right
+        for i in e.path:
+            node = node[i]
+        if e.op == 'attr':
+            node.set(e.key, e.value)
+        elif e.op == 'text':
+            node.text = e.value
+            for c in node:  # text is aggregated in front of children
+                c.tail = None
+        elif e.op == 'append':
+            node.append(e.value)
+    for path in sorted(removals, reverse=True):
+        node = right
+        for i in path[:-1]:
+            node = node[i]
+        node.remove(node[path[-1]])
+    return right
+
+
+def xml_edit_format(right, edit):
+    """ returns human readable description of edit on tree right like
+    'attr domain/devices/interface[2]/model@type=virtio' """
+    node = right
+    p = node.tag
+    for i in edit.path:
+        child = node[i]
+        same = [c for c in node if c.tag == child.tag]
+        p += "/" + child.tag
+        if len(same) > 1:
+            p += "[%d]" % (same.index(child) + 1)
+        node = child
+    if edit.op == 'attr':
+        return "%s %s@%s=%s" % (edit.op, p, edit.key, edit.value)
+    elif edit.op == 'text':
+        return "%s %s=%s" % (edit.op, p, edit.value)
+    elif edit.op == 'remove':
+        return "%s %s" % (edit.op, p)
+    return "%s %s/%s" % (edit.op, p, edit.value.tag)
+
+
+def xml_cmp(left, right, alter=True, rules=None):
+    ''' if alter is given: report change by returning false AND alter right
+    tree. otherwise just return false if a alteration of the right tree would
+    be needed. '''
+    edits = xml_diff(left, right, rules)
+    if alter:
+        xml_apply_edits(right, edits)
+    return not xml_changed(edits)
+
+
+def xml_digest(xml):
+    """ returns hex digest of a xml document given as (byte) string """
+    if not isinstance(xml, bytes):
+        xml = xml.encode('utf-8')
+    return hashlib.sha256(xml).hexdigest()
+
+
+def xml_edit_key(right, edit):
+    """ returns string identifying edit on tree right including its value """
+    key = xml_edit_format(right, edit)
+    if edit.op == 'append':
+        key += "#" + xml_digest(ET.tostring(edit.value))[:16]
+    return key
+
+
+# factors of units used by libvirt for memory sizes (lower case)
+unit_factors = {
+    'b': 1, 'bytes': 1,
+    'kb': 10**3, 'k': 2**10, 'kib': 2**10,
+    'mb': 10**6, 'm': 2**20, 'mib': 2**20,
+    'gb': 10**9, 'g': 2**30, 'gib': 2**30,
+    'tb': 10**12, 't': 2**40, 'tib': 2**40,
+    'pb': 10**15, 'p': 2**50, 'pib': 2**50,
+    'eb': 10**18, 'e': 2**60, 'eib': 2**60,
+}
+
+# elements whose size is given in KiB if there is no unit attribute
+unit_kib_default = ['memory', 'currentMemory', 'maxMemory']
+
+
+def xml_normalize_units(root):
+    """ converts sizes given with a unit attribute to KiB the way libvirt
+    reports them (e.g. <memory unit='M'>1024</memory> becomes
+    <memory unit='KiB'>1048576</memory>). The size is taken from the text or
+    from attribute 'size' or 'memory'. Sizes which are no multiple of KiB
+    are kept. alters root in place and returns it. """
+    for e in root.iter():
+        unit = e.get('unit')
+        text = e.text.strip() if e.text else ""
+        if unit is None:
+            if e.tag in unit_kib_default and text.isdigit():
+                e.set('unit', 'KiB')
+            continue
+        factor = unit_factors.get(unit.lower())
+        if factor is None:
+            continue
+        for attr in ('size', 'memory'):
+            if e.get(attr, '').isdigit():
+                value = int(e.get(attr)) * factor
+                if value % 1024 == 0:
+                    e.set(attr, str(value // 1024))
+                    e.set('unit', 'KiB')
+                break
+        else:
+            if text.isdigit():
+                value = int(text) * factor
+                if value % 1024 == 0:
+                    e.text = str(value // 1024)
+                    e.set('unit', 'KiB')
+    return root
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+""" tests of the NUMA aware pinning of module_utils/virt_common/numa.py
+using synthetic cells and a fake connection returning fixed XML
+
+    python numa_test.py  (or pytest)
+"""
+
+import os
+import unittest
+import xml.etree.ElementTree as ET
+
+try:
+    import ansible.module_utils
+except ImportError:
+    ansible = None
+else:
+    MODULE_UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'module_utils')
+    if MODULE_UTILS not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(MODULE_UTILS)
+    from ansible.module_utils.virt_common.numa import cpuset_parse, \
+        cpuset_format, xml_memory, host_cells, pinning_used, numa_plan, \
+        numa_merge
+
+GiB = 1024 * 1024  # in KiB
+
+# two cells of two cores having two threads each. thread siblings have
+# the ids n and n + 2.
+capabilities = '''<capabilities><host><topology><cells num="2">
+  <cell id="0"><memory unit="KiB">4194304</memory><cpus num="4">
+    <cpu id="0" socket_id="0" core_id="0"/>
+    <cpu id="1" socket_id="0" core_id="1"/>
+    <cpu id="2" socket_id="0" core_id="0"/>
+    <cpu id="3" socket_id="0" core_id="1"/>
+  </cpus></cell>
+  <cell id="1"><memory unit="GiB">4</memory><cpus num="4">
+    <cpu id="4" socket_id="1" core_id="0"/>
+    <cpu id="5" socket_id="1" core_id="1"/>
+    <cpu id="6" socket_id="1" core_id="0"/>
+    <cpu id="7" socket_id="1" core_id="1"/>
+  </cpus></cell>
+</cells></topology></host></capabilities>'''
+
+
+class FakeDomain(object):
+    def __init__(self, uuid, xml):
+        self.uuid = uuid
+        self.xml = xml
+
+    def UUIDString(self):
+        return self.uuid
+
+    def XMLDesc(self, flags):
+        return self.xml
+
+
+class FakeConn(object):
+    def __init__(self, domains=()):
+        self.domains = list(domains)
+
+    def getCapabilities(self):
+        return capabilities
+
+    def listAllDomains(self, flags):
+        return self.domains
+
+
+def pinned(uuid, cpuset, nodeset, memory):
+    return FakeDomain(uuid, '''<domain><memory unit="KiB">%d</memory>
+        <cputune><vcpupin vcpu="0" cpuset="%s"/></cputune>
+        <numatune><memory mode="strict" nodeset="%s"/></numatune>
+        </domain>''' % (memory, cpuset, nodeset))
+
+
+def cell(id, cpus, memory):
+    return dict(id=id, cpus=list(cpus), memory=memory)
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class CpusetTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(cpuset_parse('0-3,^2,8'), set([0, 1, 3, 8]))
+        self.assertEqual(cpuset_parse(' 5 , '), set([5]))
+        self.assertEqual(cpuset_parse(''), set())
+
+    def test_format(self):
+        self.assertEqual(cpuset_format([8, 0, 1, 3, 2, 5]), '0-3,5,8')
+        self.assertEqual(cpuset_format([]), '')
+        self.assertEqual(cpuset_parse(cpuset_format([1, 2, 4])),
+                         set([1, 2, 4]))
+
+    def test_memory(self):
+        self.assertEqual(xml_memory(ET.fromstring('<m unit="GiB">2</m>')),
+                         2 * GiB)
+        self.assertEqual(xml_memory(ET.fromstring('<m>1024</m>')), 1024)
+        self.assertEqual(xml_memory(None), 0)
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class PlanTest(unittest.TestCase):
+
+    cells = [cell(0, range(0, 4), 4 * GiB), cell(1, range(4, 8), 4 * GiB)]
+
+    def test_least_loaded_cell(self):
+        self.assertEqual(numa_plan(self.cells, set([0]), {}, 2, GiB),
+                         [(1, [4, 5], GiB)])
+        self.assertEqual(numa_plan(self.cells, set(), {}, 2, GiB),
+                         [(0, [0, 1], GiB)])  # ties by id
+
+    def test_memory_of_cell_used(self):
+        self.assertEqual(numa_plan(self.cells, set([0]), {1: 3 * GiB}, 2,
+                                   2 * GiB), [(0, [1, 2], 2 * GiB)])
+
+    def test_spanning_cells(self):
+        memory = 3 * GiB + 100
+        plan = numa_plan(self.cells, set(), {}, 6, memory)
+        # shares are rounded down to MiB, the last cell gets the rest
+        self.assertEqual(plan, [(0, [0, 1, 2, 3], 2048 * 1024),
+                                (1, [4, 5], memory - 2048 * 1024)])
+        self.assertEqual(sum(p[2] for p in plan), memory)
+
+    def test_cell_lacking_memory_skipped(self):
+        cells = [cell(0, range(0, 4), 512 * 1024)] + \
+            [cell(c['id'] + 1, [i + 4 for i in c['cpus']], c['memory'])
+             for c in self.cells]
+        plan = numa_plan(cells, set(), {}, 6, 2 * GiB)
+        share = 2 * GiB * 4 // 6 // 1024 * 1024
+        self.assertEqual(plan, [(1, [4, 5, 6, 7], share),
+                                (2, [8, 9], 2 * GiB - share)])
+
+    def test_no_resources(self):
+        self.assertIsNone(numa_plan(self.cells, set(), {}, 9, GiB))
+        self.assertIsNone(numa_plan(self.cells, set(), {}, 2, 9 * GiB))
+        self.assertIsNone(numa_plan(self.cells, set(range(7)), {}, 2, GiB))
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class MergeTest(unittest.TestCase):
+
+    def test_host_cells(self):
+        cells = host_cells(ET.fromstring(capabilities))
+        self.assertEqual(cells, [cell(0, [0, 2, 1, 3], 4 * GiB),
+                                 cell(1, [4, 6, 5, 7], 4 * GiB)])
+
+    def test_pinning_used(self):
+        conn = FakeConn([pinned('a', '0-1', '0', GiB),
+                         pinned('b', '4', '0-1', 2 * GiB),
+                         pinned('c', '7', '1', GiB)])
+        self.assertEqual(pinning_used(conn, skip='c'),
+                         (set([0, 1, 4]), {0: 2 * GiB, 1: GiB}))
+
+    def test_merge(self):
+        conn = FakeConn([pinned('other', '0', '0', GiB),
+                         pinned('self', '4-7', '1', GiB)])
+        root = ET.fromstring('<domain><vcpu>2</vcpu>'
+                             '<memory unit="GiB">1</memory></domain>')
+        numa_merge(conn, root, uuid='self')
+        self.assertEqual([(p.get('vcpu'), p.get('cpuset'))
+                          for p in root.findall('cputune/vcpupin')],
+                         [('0', '4'), ('1', '6')])  # siblings
+        self.assertEqual(root.find('cputune/emulatorpin').get('cpuset'),
+                         '4,6')
+        self.assertEqual(root.find('numatune/memory').attrib,
+                         dict(mode='strict', nodeset='1'))
+        self.assertEqual(root.findall('numatune/memnode'), [])
+        self.assertEqual(root.find('cpu/numa/cell').attrib,
+                         dict(id='0', cpus='0-1', memory=str(GiB),
+                              unit='KiB'))
+
+    def test_merge_spanning(self):
+        root = ET.fromstring('<domain><vcpu>6</vcpu><memory>%d</memory>'
+                             '<numatune><memory mode="preferred" '
+                             'nodeset="0"/></numatune></domain>' % GiB)
+        numa_merge(FakeConn(), root)
+        self.assertEqual(root.find('cputune/emulatorpin').get('cpuset'),
+                         '0-4,6')
+        # numatune given by the definition is kept
+        self.assertEqual(root.find('numatune/memory').get('mode'),
+                         'preferred')
+        self.assertEqual([(c.get('cpus'), c.get('memory'))
+                          for c in root.findall('cpu/numa/cell')],
+                         [('0-3', str(682 * 1024)),
+                          ('4-5', str(GiB - 682 * 1024))])
+
+    def test_pinned_domain_kept(self):
+        xml = ('<domain><vcpu>1</vcpu><cputune><vcpupin vcpu="0" '
+               'cpuset="3"/></cputune></domain>')
+        root = numa_merge(FakeConn(), ET.fromstring(xml))
+        self.assertEqual(ET.tostring(root), ET.tostring(ET.fromstring(xml)))
+
+    def test_no_resources(self):
+        root = ET.fromstring('<domain><vcpu>9</vcpu></domain>')
+        self.assertRaises(ValueError, numa_merge, FakeConn(), root)
+
+
+if __name__ == '__main__':
+    unittest.main()
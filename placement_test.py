@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+""" tests of the placement of domains of
+module_utils/virt_common/placement.py on hand-built host resources
+
+    python placement_test.py  (or pytest)
+"""
+
+import os
+import unittest
+
+try:
+    import ansible.module_utils
+except ImportError:
+    ansible = None
+else:
+    MODULE_UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'module_utils')
+    if MODULE_UTILS not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(MODULE_UTILS)
+    from ansible.module_utils.virt_common.placement import spec_normalize, \
+        page_size, host_fit, host_consume, placement_plan
+
+GiB = 1024 * 1024  # in KiB
+
+
+def host(memory, cpus=8, vcpus=0, cells=None, hugepages=None, domains=None):
+    return dict(cpus=cpus, vcpus=vcpus, memory=memory,
+                cells=cells if cells is not None else [memory],
+                hugepages=hugepages or {}, domains=domains or {})
+
+
+def spec(name, memory, vcpus=1, hugepages=0):
+    return dict(name=name, memory=memory, vcpus=vcpus, hugepages=hugepages)
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class SpecTest(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(spec_normalize(dict(name='a', memory=2,
+                                             memory_unit='GiB')),
+                         spec('a', 2 * GiB))
+        self.assertEqual(spec_normalize(dict(name='a', memory='1024',
+                                             vcpus='2', hugepages=True)),
+                         spec('a', 1024, 2, True))
+        self.assertRaises(ValueError, spec_normalize,
+                          dict(name='a', memory=1, memory_unit='parsec'))
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class FitTest(unittest.TestCase):
+
+    def test_memory_and_reserve(self):
+        h = host(4 * GiB)
+        self.assertEqual(host_fit(h, spec('a', 2 * GiB), 4.0, GiB), GiB)
+        self.assertEqual(host_fit(h, spec('a', 3 * GiB), 4.0, GiB), 0)
+        self.assertIsNone(host_fit(h, spec('a', 3 * GiB + 1), 4.0, GiB))
+
+    def test_cpu_ratio(self):
+        h = host(4 * GiB, cpus=2, vcpus=3)
+        self.assertIsNotNone(host_fit(h, spec('a', 1, 1), 2.0, 0))
+        self.assertIsNone(host_fit(h, spec('a', 1, 2), 2.0, 0))
+
+    def test_hugepages(self):
+        h = host(GiB, hugepages={2048: 1024, 1048576: 1})
+        self.assertEqual(page_size(h, spec('a', GiB, hugepages=True)), 2048)
+        self.assertEqual(page_size(h, spec('a', GiB, hugepages=1048576)),
+                         1048576)
+        self.assertIsNone(page_size(h, spec('a', GiB, hugepages=4)))
+        # huge pages do not count the normal free memory and the reserve
+        self.assertEqual(host_fit(h, spec('a', GiB, hugepages=True),
+                                  4.0, GiB), GiB)
+        self.assertIsNone(host_fit(h, spec('a', 3 * GiB, hugepages=True),
+                                   4.0, 0))
+
+    def test_hugepages_missing(self):
+        h = host(8 * GiB)
+        self.assertIsNone(page_size(h, spec('a', GiB, hugepages=True)))
+        self.assertIsNone(host_fit(h, spec('a', GiB, hugepages=True), 4.0, 0))
+        self.assertEqual(placement_plan(
+            dict(h1=h), [spec('a', GiB, hugepages=True)], reserve=0),
+            ({}, ['a']))
+
+    def test_consume(self):
+        h = host(6 * GiB, cells=[4 * GiB, 2 * GiB])
+        host_consume(h, spec('a', GiB, 2))
+        self.assertEqual((h['vcpus'], h['memory'], h['cells']),
+                         (2, 5 * GiB, [4 * GiB, GiB]))  # smallest fitting
+        host_consume(h, spec('b', 5 * GiB))
+        self.assertEqual((h['memory'], h['cells']), (0, [0, GiB]))
+
+    def test_consume_hugepages(self):
+        h = host(GiB, hugepages={2048: 10})
+        host_consume(h, spec('a', 2049, hugepages=2048))
+        self.assertEqual((h['hugepages'], h['memory']), ({2048: 8}, GiB))
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class PlanTest(unittest.TestCase):
+
+    def hosts(self):
+        return dict(small=host(4 * GiB), large=host(16 * GiB))
+
+    def test_pack(self):
+        plan, unplaced = placement_plan(self.hosts(), [spec('a', 2 * GiB)],
+                                        'pack', reserve=0)
+        self.assertEqual((plan, unplaced), (dict(a='small'), []))
+
+    def test_spread(self):
+        plan, unplaced = placement_plan(self.hosts(), [spec('a', 2 * GiB)],
+                                        'spread', reserve=0)
+        self.assertEqual((plan, unplaced), (dict(a='large'), []))
+
+    def test_largest_first(self):
+        hosts = self.hosts()
+        plan, _ = placement_plan(hosts, [spec('a', 2 * GiB),
+                                         spec('b', 4 * GiB)], reserve=0)
+        self.assertEqual(plan, dict(a='large', b='small'))
+        self.assertEqual((hosts['small']['memory'], hosts['large']['memory']),
+                         (0, 14 * GiB))
+
+    def test_fits_nowhere(self):
+        plan, unplaced = placement_plan(
+            self.hosts(), [spec('a', 15 * GiB), spec('b', 20 * GiB),
+                           spec('c', GiB, vcpus=64)], reserve=GiB)
+        self.assertEqual((plan, sorted(unplaced)),
+                         (dict(a='large'), ['b', 'c']))
+
+    def test_single_cell_preferred(self):
+        hosts = dict(split=host(8 * GiB, cells=[4 * GiB, 4 * GiB]),
+                     whole=host(12 * GiB, cells=[12 * GiB]))
+        plan, _ = placement_plan(hosts, [spec('a', 6 * GiB)], 'pack',
+                                 reserve=0)
+        self.assertEqual(plan, dict(a='whole'))
+
+    def test_defined_domain_stays(self):
+        hosts = self.hosts()
+        hosts['large']['domains'] = dict(a='defined', b='running')
+        plan, unplaced = placement_plan(
+            hosts, [spec('a', 2 * GiB, 2), spec('b', 2 * GiB, 2)], 'pack',
+            reserve=0)
+        self.assertEqual((plan, unplaced), (dict(a='large', b='large'), []))
+        # only the stopped one is started there and consumes resources
+        self.assertEqual((hosts['large']['memory'], hosts['large']['vcpus']),
+                         (14 * GiB, 2))
+        self.assertEqual(hosts['small']['memory'], 4 * GiB)
+
+    def test_defined_twice(self):
+        hosts = self.hosts()
+        hosts['small']['domains'] = dict(a='defined')
+        hosts['large']['domains'] = dict(a='running')
+        self.assertRaises(ValueError, placement_plan, hosts,
+                          [spec('a', GiB)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+""" tests of library/virt_domain.py. Digests of live definitions are tested
+using the test:///default driver of libvirt.
+
+    python virt_domain_test.py  (or pytest)
+"""
+
+import os
+import unittest
+import xml.etree.ElementTree as ET
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+try:
+    import ansible.module_utils
+except ImportError:
+    virt_domain = None
+else:
+    MODULE_UTILS = os.path.join(ROOT, 'module_utils')
+    if MODULE_UTILS not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(MODULE_UTILS)
+
+    def load_library(name):
+        """ loads module library/<name>.py without running it """
+        path = os.path.join(ROOT, 'library', name + '.py')
+        try:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(name, path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except ImportError:  # python 2
+            import imp
+            module = imp.load_source(name, path)
+        return module
+    virt_domain = load_library('virt_domain')
+    from ansible.module_utils.virt_common import libvirt_available
+    from ansible.module_utils.virt_common.xmlutil import xml_rules, \
+        xml_edit_key
+
+states = ['undefined', 'defined', 'running', 'paused', 'saved']
+
+
+def methods(plan):
+    return [t.method for t in plan]
+
+
+@unittest.skipIf(virt_domain is None, "ansible is not installed")
+class StatePlanTest(unittest.TestCase):
+
+    def test_paths_are_shortest(self):
+        plan = virt_domain.state_plan
+        self.assertEqual(methods(plan('undefined', 'paused')),
+                         ['define', 'start', 'pause'])
+        self.assertEqual(methods(plan('paused', 'undefined')),
+                         ['resume', 'shutdown', 'undefine'])
+        self.assertEqual(methods(plan('running', 'defined', graceful=False)),
+                         ['destroy'])
+        self.assertEqual(methods(plan('paused', 'saved')), ['save'])
+        self.assertEqual(methods(plan('saved', 'defined')), ['discard'])
+
+    def test_paths_are_chained_transitions(self):
+        for options in [(False, False), (False, True), (True, True)]:
+            plans = virt_domain.state_plans_for(*options)
+            for (start, dest), path in plans.items():
+                self.assertTrue(path)
+                self.assertEqual(path[0].source, start)
+                self.assertEqual(path[-1].dest, dest)
+                for a, b in zip(path, path[1:]):
+                    self.assertEqual(a.dest, b.source)
+
+    def test_persistent_states_are_connected(self):
+        plans = virt_domain.state_plans_for()
+        for a in states:
+            for b in states:
+                if a != b:
+                    self.assertIn((a, b), plans)
+
+    def test_transient_domains_can_not_be_saved(self):
+        plans = virt_domain.state_plans_for(transient=True)
+        self.assertEqual(methods(plans[('undefined', 'running')]), ['create'])
+        self.assertEqual(methods(plans[('running', 'undefined')]),
+                         ['shutdown'])
+        self.assertFalse(any('saved' in key for key in plans))
+        self.assertEqual(virt_domain.state_plan('running', 'saved',
+                                                transient=True), ())
+
+    def test_plans_are_built_once(self):
+        self.assertIs(virt_domain.state_plans_for(True, False),
+                      virt_domain.state_plans_for(True, False))
+
+    def test_transition_without_path(self):
+        self.assertFalse(virt_domain.state_transition('running', 'saved',
+                                                      transient=True))
+
+
+@unittest.skipIf(virt_domain is None, "ansible is not installed")
+class DigestTest(unittest.TestCase):
+
+    xml = '<domain><vcpu>%d</vcpu></domain>'
+
+    def test_definition_digest(self):
+        params = dict(xml=self.xml % 1)
+        digest = virt_domain.definition_digest(params)
+        self.assertEqual(digest, virt_domain.definition_digest(
+            dict(params, name='other', state='running')))
+        self.assertNotEqual(digest, virt_domain.definition_digest(
+            dict(params, xml=self.xml % 2)))
+        self.assertNotEqual(digest, virt_domain.definition_digest(
+            dict(params, ignore=['vcpu'])))
+
+
+@unittest.skipIf(virt_domain is None, "ansible is not installed")
+class LearnedEditTest(unittest.TestCase):
+
+    xml_def = ('<domain><vcpu>2</vcpu><devices><interface type="network">'
+               '<mac address="52:54:00:00:00:01"/><model type="virtio"/>'
+               '</interface></devices></domain>')
+    xml_curr = ('<domain><vcpu>1</vcpu><devices><interface type="network">'
+                '<mac address="52:54:00:00:00:01"/><model type="e1000"/>'
+                '</interface></devices></domain>')
+
+    def test_learned_edits_are_ignored(self):
+        rules = xml_rules()
+        xml_def = ET.fromstring(self.xml_def)
+        xml_curr = ET.fromstring(self.xml_curr)
+        edits = virt_domain.edit_script(xml_def, xml_curr, rules)
+        self.assertEqual([e.ignored for e in edits], [False, False])
+        learned = [xml_edit_key(xml_curr, edits[1])]
+        edits = virt_domain.edit_script(xml_def, xml_curr, rules, learned)
+        self.assertEqual([e.ignored for e in edits], [False, True])
+        self.assertEqual(edits[0].value, '2')
+
+
+@unittest.skipIf(virt_domain is None or not libvirt_available(),
+                 "ansible or libvirt is not installed")
+class LiveDigestTest(unittest.TestCase):
+
+    xml = ('<domain type="test"><name>virt_domain_test</name>'
+           '<memory>%d</memory><os><type>hvm</type></os></domain>')
+
+    def setUp(self):
+        import libvirt
+        self.conn = libvirt.open('test:///default')
+        self.domain = self.conn.defineXML(self.xml % 65536)
+
+    def tearDown(self):
+        self.domain.undefine()
+        self.conn.close()
+
+    def test_metadata_does_not_change_digest(self):
+        digest = virt_domain.live_digest(self.domain)
+        virt_domain.metadata_write(self.domain, 'applied', ['key'])
+        self.assertEqual(virt_domain.live_digest(self.domain), digest)
+        meta = virt_domain.metadata_read(self.domain)
+        self.assertEqual(meta['applied'], 'applied')
+        self.assertEqual(meta['live'], digest)
+        self.assertEqual(meta['learned'], ['key'])
+
+    def test_changes_change_digest(self):
+        digest = virt_domain.live_digest(self.domain)
+        self.conn.defineXML(self.xml % 32768)
+        self.assertNotEqual(virt_domain.live_digest(self.domain), digest)
+
+    def test_metadata_of_new_domain_is_empty(self):
+        self.assertEqual(virt_domain.metadata_read(self.domain),
+                         dict(learned=[]))
+
+
+if __name__ == '__main__':
+    unittest.main()
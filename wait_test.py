@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+""" tests of wait_for of module_utils/virt_common/state.py against the
+test:///default driver of libvirt. Domains change their state from a timer
+while waiting, either delivering events or being polled.
+
+    python wait_test.py  (or pytest)
+"""
+
+import os
+import threading
+import time
+import unittest
+
+try:
+    import ansible.module_utils
+except ImportError:
+    ansible = None
+else:
+    MODULE_UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'module_utils')
+    if MODULE_UTILS not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(MODULE_UTILS)
+    from ansible.module_utils.virt_common import libvirt, libvirt_available
+    from ansible.module_utils.virt_common.connection import lookup
+    from ansible.module_utils.virt_common.state import dom_state, \
+        event_loop_start, wait_for
+
+xml = ('<domain type="test"><name>%s</name><memory>65536</memory>'
+       '<os><type>hvm</type></os></domain>')
+
+# seconds after which the state changes and wait_for has to return at most
+delay = 0.3
+returned = 5  # far below 'sleep' of the waits
+
+
+@unittest.skipIf(ansible is None or not libvirt_available(),
+                 "ansible or libvirt is not installed")
+class WaitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = event_loop_start()  # before opening the connection
+        self.conn = libvirt.open('test:///default')
+        self.domain = self.conn.createXML(xml % 'wait_test', 0)
+        self.timers = []
+
+    def tearDown(self):
+        for t in self.timers:
+            t.join()
+        for name in ('wait_test', 'wait_test_new'):
+            domain = lookup(self.conn.lookupByName, name,
+                            libvirt.VIR_ERR_NO_DOMAIN)
+            if domain and domain.isActive():
+                domain.destroy()
+            if domain and domain.isPersistent():
+                domain.undefine()
+        self.conn.close()
+
+    def later(self, fn):
+        t = threading.Timer(delay, fn)
+        self.timers.append(t)
+        t.start()
+
+    def wait(self, reached, timeout=60, **kwargs):
+        """ returns result of wait_for and seconds it took """
+        start = time.time()
+        res = wait_for(self.conn, self.domain, reached, timeout, sleep=60,
+                       **kwargs)
+        return res, time.time() - start
+
+    def paused(self):
+        return dom_state(self.domain)[0] == 'paused'
+
+    def test_event(self):
+        self.assertTrue(self.events)
+        self.later(self.domain.suspend)
+        res, took = self.wait(self.paused)
+        self.assertTrue(res)
+        self.assertTrue(delay <= took < returned)
+
+    def test_event_of_any_domain(self):
+        def present():
+            return lookup(self.conn.lookupByName, 'wait_test_new',
+                          libvirt.VIR_ERR_NO_DOMAIN) is not None
+        self.later(lambda: self.conn.defineXML(xml % 'wait_test_new'))
+        start = time.time()
+        res = wait_for(self.conn, None, present, 60, sleep=60)
+        self.assertTrue(res)
+        self.assertTrue(time.time() - start < returned)
+
+    def test_polling(self):
+        self.later(self.domain.suspend)
+        res, took = self.wait(self.paused, events=())
+        self.assertTrue(res)
+        self.assertTrue(delay <= took < returned)
+
+    def test_polling_with_backoff(self):
+        self.later(self.domain.suspend)
+        res, took = self.wait(self.paused, backoff=True)
+        self.assertTrue(res)
+        self.assertTrue(delay <= took < returned)
+
+    def test_reached_already(self):
+        res, took = self.wait(lambda: True)
+        self.assertTrue(res)
+        self.assertTrue(took < delay)
+
+    def test_timeout(self):
+        res, took = self.wait(self.paused, timeout=delay)
+        self.assertFalse(res)
+        self.assertTrue(delay <= took < returned)
+        res, took = self.wait(self.paused, timeout=delay, events=())
+        self.assertFalse(res)
+        self.assertTrue(delay <= took < returned)
+
+
+if __name__ == '__main__':
+    unittest.main()
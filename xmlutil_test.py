@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+""" tests of the edit scripts of module_utils/virt_common/xmlutil.py
+
+    python xmlutil_test.py  (or pytest)
+"""
+
+import os
+import unittest
+import xml.etree.ElementTree as ET
+
+try:
+    import ansible.module_utils
+except ImportError:
+    ansible = None
+else:
+    MODULE_UTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'module_utils')
+    if MODULE_UTILS not in ansible.module_utils.__path__:
+        ansible.module_utils.__path__.append(MODULE_UTILS)
+    from ansible.module_utils.virt_common.xmlutil import xml_diff, \
+        xml_apply_edits, xml_changed, xml_rules, xml_shape, xml_fingerprint, \
+        xml_match, xml_edit_format, xml_cmp
+
+
+def diff_apply(left, right, rules=None):
+    """ returns edit script of xml strings left and right and the right tree
+    the script got applied to """
+    l, r = ET.fromstring(left), ET.fromstring(right)
+    edits = xml_diff(l, r, rules)
+    return edits, xml_apply_edits(r, edits)
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class FingerprintTest(unittest.TestCase):
+
+    def test_equal_elements_share_fingerprint(self):
+        a = ET.fromstring('<disk type="file"><target dev="vda"/></disk>')
+        b = ET.fromstring('<disk type="file"><target dev="vda" bus="x"/>'
+                          '<alias name="d0"/></disk>')
+        shape = xml_shape(a)
+        self.assertEqual(xml_fingerprint(a, shape), xml_fingerprint(b, shape))
+
+    def test_different_elements_differ(self):
+        a = ET.fromstring('<disk><target dev="vda"/></disk>')
+        b = ET.fromstring('<disk><target dev="vdb"/></disk>')
+        shape = xml_shape(a)
+        self.assertNotEqual(xml_fingerprint(a, shape),
+                            xml_fingerprint(b, shape))
+
+    def test_missing_child_has_no_fingerprint(self):
+        a = ET.fromstring('<disk><target dev="vda"/></disk>')
+        self.assertIsNone(xml_fingerprint(ET.fromstring('<disk/>'),
+                                          xml_shape(a)))
+
+    def test_repeated_children_have_no_shape(self):
+        self.assertIsNone(xml_shape(ET.fromstring('<a><b/><b/></a>')))
+
+    def test_ignored_attributes_are_left_out(self):
+        rules = xml_rules(ignore=['devices/disk@type'])
+        a = ET.fromstring('<d><devices><disk type="file"/></devices></d>')
+        b = ET.fromstring('<d><devices><disk type="block"/></devices></d>')
+        c_rules = rules.child('devices').child('disk')
+        shape = xml_shape(a[0][0], c_rules)
+        self.assertEqual(xml_fingerprint(a[0][0], shape),
+                         xml_fingerprint(b[0][0], shape))
+
+    def test_match_exact_regardless_of_order(self):
+        lefts = [ET.fromstring('<i><mac address="%s"/></i>' % m)
+                 for m in ('b', 'a')]
+        rights = [ET.fromstring('<i><mac address="%s"/><alias/></i>' % m)
+                  for m in ('a', 'b', 'c')]
+        res = xml_match(lefts, rights)
+        self.assertEqual(res, [(rights[1], True), (rights[0], True)])
+
+    def test_match_partial_leftovers(self):
+        lefts = [ET.fromstring('<i type="net"><mac address="x"/></i>')]
+        rights = [ET.fromstring('<i type="other"/>'),
+                  ET.fromstring('<i type="net"><mac address="y"/></i>')]
+        self.assertEqual(xml_match(lefts, rights), [(rights[1], False)])
+
+    def test_cmp_repeated_elements(self):
+        left = ET.fromstring('<devices><i><mac address="b"/></i>'
+                             '<i><mac address="a"/></i></devices>')
+        right = ET.fromstring('<devices><i><mac address="a"/><alias/></i>'
+                              '<i><mac address="b"/></i></devices>')
+        self.assertTrue(xml_cmp(left, right, alter=False))
+        left.append(ET.fromstring('<i><mac address="c"/></i>'))
+        self.assertFalse(xml_cmp(left, right, alter=False))
+
+
+@unittest.skipIf(ansible is None, "ansible is not installed")
+class EditScriptTest(unittest.TestCase):
+
+    def test_equal_trees_need_no_edits(self):
+        edits, _ = diff_apply('<a x="1"><b>t</b></a>',
+                              '<a x="1" y="2"><b>t</b><c/></a>')
+        self.assertEqual(edits, [])
+
+    def test_diff_does_not_alter_trees(self):
+        l = ET.fromstring('<a x="1"><b/></a>')
+        r = ET.fromstring('<a x="2"/>')
+        before = ET.tostring(l), ET.tostring(r)
+        xml_diff(l, r)
+        self.assertEqual((ET.tostring(l), ET.tostring(r)), before)
+
+    def test_apply_attr_text_append(self):
+        edits, r = diff_apply('<a x="1"><b>new</b><c y="2"/></a>',
+                              '<a x="0" z="3"><b>old</b></a>')
+        self.assertEqual([e.op for e in edits], ['attr', 'text', 'append'])
+        self.assertEqual(r.get('x'), '1')
+        self.assertEqual(r.get('z'), '3')
+        self.assertEqual(r.findtext('b'), 'new')
+        self.assertEqual(r.find('c').get('y'), '2')
+        self.assertEqual(xml_diff(ET.fromstring('<a x="1"><b>new</b>'
+                                                '<c y="2"/></a>'), r), [])
+
+    def test_repeated_elements_are_matched(self):
+        left = ('<devices><interface><mac address="b"/><model type="v"/>'
+                '</interface><interface><mac address="a"/></interface>'
+                '</devices>')
+        right = ('<devices><interface><mac address="a"/><alias/></interface>'
+                 '<interface><mac address="b"/><model type="e"/></interface>'
+                 '</devices>')
+        edits, r = diff_apply(left, right)
+        self.assertEqual([xml_edit_format(r, e) for e in edits],
+                         ['attr devices/interface[2]/model@type=v'])
+        self.assertIsNotNone(r[0].find('alias'))  # kept on its element
+
+    def test_exclusive_removes_unmatched(self):
+        rules = xml_rules(exclusive=['devices/disk'])
+        edits, r = diff_apply(
+            '<domain><devices><disk dev="a"/></devices></domain>',
+            '<domain><devices><disk dev="b"/><disk dev="a"/><x/></devices>'
+            '</domain>', rules)
+        self.assertEqual([e.op for e in edits], ['remove'])
+        self.assertEqual([d.get('dev') for d in r.findall('devices/disk')],
+                         ['a'])
+        self.assertIsNotNone(r.find('devices/x'))
+
+    def test_ignored_edits_are_not_changes(self):
+        rules = xml_rules(ignore=['os', 'clock@offset'])
+        edits, _ = diff_apply(
+            '<domain><os><type>hvm</type></os><clock offset="utc"/></domain>',
+            '<domain><os><type>xen</type></os><clock offset="lo"/></domain>',
+            rules)
+        self.assertEqual([(e.op, e.ignored) for e in edits],
+                         [('text', True), ('attr', True)])
+        self.assertFalse(xml_changed(edits))
+
+    def test_pruned_elements_are_not_compared(self):
+        rules = xml_rules(prune=['clock', 'devices/*'])
+        edits, _ = diff_apply(
+            '<domain><clock offset="utc"/><devices><disk/></devices>'
+            '<vcpu>2</vcpu></domain>',
+            '<domain><clock offset="lo"/><devices/><vcpu>1</vcpu></domain>',
+            rules)
+        self.assertEqual([(e.op, e.value) for e in edits], [('text', '2')])
+
+    def test_sections_restrict_comparison(self):
+        rules = xml_rules(sections=['devices/disk'])
+        edits, _ = diff_apply(
+            '<domain type="kvm"><name>a</name><devices><disk dev="x"/>'
+            '<interface/></devices></domain>',
+            '<domain type="qemu"><name>b</name><devices><disk dev="y"/>'
+            '</devices></domain>', rules)
+        self.assertEqual([(e.op, e.key, e.value) for e in edits],
+                         [('attr', 'dev', 'x')])
+
+
+if __name__ == '__main__':
+    unittest.main()